@@ -0,0 +1,62 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module moves stories which are no longer on the monitored reddit
+pages (at infinity_position) and were added more than config.archive_age
+seconds ago from the stories table to the stories_archive table.
+
+This keeps the stories table, which river pages are read from, about as
+big as the monitored pages. Stats pages read summary tables which cover
+archived stories too (see summary.py).
+Archived stories keep their ids, so their story_history stays theirs.
+"""
+
+import sys
+import time
+import riverdb
+from ranking import infinity_position
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+columns = ("id, title, url, url_mobile, reddit_id, subreddit_id, score, comments, "
+           "user, position, date_reddit, date_added")
+
+class Archiver(object):
+    """ Moves demoted stories to the archive """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def archive(self, now=None):
+        """ Archives demoted stories older than config.archive_age,
+        returns how many were archived. Bumps the stories generations of
+        the subreddits they were in. Does not commit. """
+
+        now = now or int(time.time())
+        params = (infinity_position, now - config.archive_age)
+        where = "position = ? AND date_added < ?"
+
+        cur = self.conn.cursor()
+        cur.execute("SELECT DISTINCT subreddit_id FROM stories WHERE %s" % where, params)
+        for row in cur.fetchall():
+            riverdb.bump_generation(self.conn, riverdb.stories_generation(row[0]))
+        cur.execute("INSERT OR REPLACE INTO stories_archive (%s, date_archived) "
+                    "SELECT %s, %d FROM stories WHERE %s" % (columns, columns, now, where), params)
+        cur.execute("DELETE FROM autodisc_queue WHERE story_id IN (SELECT id FROM stories WHERE %s)"
+                    % where, params)
+        cur.execute("DELETE FROM stories WHERE %s" % where, params)
+        return cur.rowcount
+
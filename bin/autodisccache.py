@@ -0,0 +1,242 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module keeps autodiscovery results in the database, so that the
+same article posted to several subreddits (or seen again on the next run)
+is not fetched and parsed again.
+
+ * autodisc_cache table maps a normalized url to its mobile url, or to
+   'none' (nothing was found) or 'error' (the page could not be fetched).
+   Each kind of result expires after its own TTL (see riverconfig).
+ * autodisc_domains table counts pages of a domain which had no mobile
+   version. Domains which have never yielded a mobile version after
+   config.autodisc_domain_misses pages are skipped without fetching
+   anything until config.autodisc_domain_ttl passes.
+ * autodisc_queue table holds new stories whose mobile url has not been
+   autodiscovered yet (their url_mobile is NULL). update_stories.py adds
+   them, update_mobile.py drains it.
+
+The cache uses the connection it is given, so it must only be used from
+the thread which owns that connection.
+"""
+
+import sys
+import time
+import urlparse
+import autodiscovery
+import riverdb
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+schema = (
+    "CREATE TABLE IF NOT EXISTS autodisc_cache ("
+    "  url           TEXT       PRIMARY KEY,"
+    "  url_mobile    TEXT,"
+    "  status        TEXT       NOT NULL,"
+    "  date_checked  UNIX_DATE  NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS autodisc_domains ("
+    "  domain        TEXT       PRIMARY KEY,"
+    "  hits          INTEGER    NOT NULL  DEFAULT 0,"
+    "  misses        INTEGER    NOT NULL  DEFAULT 0,"
+    "  date_checked  UNIX_DATE  NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS autodisc_queue ("
+    "  story_id      INTEGER    PRIMARY KEY,"
+    "  url           TEXT       NOT NULL,"
+    "  host          TEXT       NOT NULL,"
+    "  attempts      INTEGER    NOT NULL  DEFAULT 0,"
+    "  next_attempt  UNIX_DATE  NOT NULL,"
+    "  last_error    TEXT"
+    ")",
+    "CREATE INDEX IF NOT EXISTS idx_autodisc_queue_next ON autodisc_queue (next_attempt)"
+)
+
+def normalize_url(url):
+    """ Normalizes url for use as a cache key, for example:
+        >>> normalize_url('HTTP://WWW.Example.com:80/a?b=1#top')
+        'http://www.example.com/a?b=1' """
+
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    scheme = scheme.lower()
+    host = host.lower()
+    if scheme == 'http' and host.endswith(':80'):
+        host = host[:-3]
+    return urlparse.urlunsplit((scheme, host, path or '/', query, ''))
+
+class AutoDiscoveryCache(object):
+    """ Cache of autodiscovery results in the database """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.ttls = {'found': config.autodisc_ttl_found,
+                     'none': config.autodisc_ttl_none,
+                     'error': config.autodisc_ttl_error}
+        self.counters = dict.fromkeys(('hits', 'misses', 'domain_skips', 'errors'), 0)
+        cur = conn.cursor()
+        for query in schema:
+            cur.execute(query)
+
+    def lookup(self, url):
+        """
+        Returns a tuple of the cached result status ('found', 'none' or
+        'error'), mobile url of url and the time the result expires, or
+        None if url has to be fetched. Urls of skipped domains are reported
+        as 'none'. An 'error' means that url should not be fetched again
+        before the result expires.
+        """
+
+        key = normalize_url(url)
+        now = int(time.time())
+        cur = self.conn.cursor()
+
+        cur.execute("SELECT url_mobile, status, date_checked FROM autodisc_cache WHERE url = ?", (key,))
+        row = cur.fetchone()
+        if row and row[2] + self.ttls[row[1]] > now:
+            self.counters['hits'] += 1
+            return row[1], row[0], row[2] + self.ttls[row[1]]
+
+        domain = autodiscovery.registrable_domain(urlparse.urlsplit(url)[1])
+        cur.execute("SELECT hits, misses, date_checked FROM autodisc_domains WHERE domain = ?", (domain,))
+        domain_row = cur.fetchone()
+        if (domain_row and domain_row[0] == 0 and domain_row[1] >= config.autodisc_domain_misses
+                and domain_row[2] + config.autodisc_domain_ttl > now):
+            self.counters['domain_skips'] += 1
+            return 'none', None, domain_row[2] + config.autodisc_domain_ttl
+
+        self.counters['misses'] += 1
+        return None
+
+    def store(self, url, url_mobile, error=False):
+        """ Caches the result of autodiscovering url """
+
+        key = normalize_url(url)
+        now = int(time.time())
+        if error:
+            self.counters['errors'] += 1
+            self._store(key, None, 'error', now)
+            return
+
+        if url_mobile:
+            self._store(key, url_mobile, 'found', now)
+        else:
+            self._store(key, None, 'none', now)
+        domain = autodiscovery.registrable_domain(urlparse.urlsplit(url)[1])
+        self._count_domain(domain, bool(url_mobile), now)
+
+    def _store(self, key, url_mobile, status, now):
+        self.conn.execute("INSERT OR REPLACE INTO autodisc_cache (url, url_mobile, status, date_checked) "
+                          "VALUES (?, ?, ?, ?)", (key, url_mobile, status, now))
+
+    def _count_domain(self, domain, found, now):
+        """ Counts a page of domain with (found is True) or without mobile version """
+
+        if found:
+            hits, misses = 1, 0
+        else:
+            hits, misses = 0, 1
+        self.conn.execute("INSERT OR IGNORE INTO autodisc_domains (domain, date_checked) VALUES (?, ?)",
+            (domain, now))
+        self.conn.execute("UPDATE autodisc_domains SET hits = hits + ?, misses = misses + ?, "
+                          "date_checked = ? WHERE domain = ?", (hits, misses, now, domain))
+
+    def print_stats(self):
+        print ("Autodiscovery cache: %(hits)d hits, %(misses)d misses, %(domain_skips)d "
+               "domain skips, %(errors)d errors" % self.counters)
+
+class AutoDiscoveryQueue(object):
+    """ Queue of stories waiting for autodiscovery of their mobile url """
+
+    def __init__(self, conn):
+        self.conn = conn
+        cur = conn.cursor()
+        for query in schema:
+            cur.execute(query)
+
+    def put_many(self, stories):
+        """ Queues (story_id, url, next_attempt) stories which were inserted
+        with NULL url_mobile, next_attempt None means now """
+        now = int(time.time())
+        self.conn.executemany("INSERT OR REPLACE INTO autodisc_queue (story_id, url, host, next_attempt) "
+            "VALUES (?, ?, ?, ?)", [(story_id, url, urlparse.urlsplit(url)[1].lower(), next_attempt or now)
+                                    for story_id, url, next_attempt in stories])
+
+    def get_due(self, limit, per_host):
+        """
+        Returns at most 'limit' queued stories which are due, newest first,
+        and at most 'per_host' of them for any host, so that a slow host
+        can't take all the workers. Each story is a row of story_id, url,
+        host and attempts.
+        """
+
+        cur = self.conn.cursor()
+        cur.execute("SELECT story_id, url, host, attempts FROM autodisc_queue "
+                    "WHERE next_attempt <= ? ORDER BY story_id DESC", (int(time.time()),))
+        due = []
+        hosts = {}
+        for row in cur:
+            if hosts.get(row[2], 0) >= per_host:
+                continue
+            hosts[row[2]] = hosts.get(row[2], 0) + 1
+            due.append(row)
+            if len(due) >= limit:
+                break
+        return due
+
+    def done(self, story_id, url_mobile):
+        """ Sets url_mobile of a story (an empty string if it has none), in
+        top_stories summary too, and removes the story from the queue. If
+        the story got a mobile url, the stories generation of its subreddit
+        is bumped. """
+
+        self.conn.execute("UPDATE stories SET url_mobile = ? WHERE id = ?", (url_mobile or "", story_id))
+        self.conn.execute("UPDATE top_stories SET url_mobile = ? WHERE story_id = ?", (url_mobile or "", story_id))
+        if url_mobile:
+            row = self.conn.execute("SELECT subreddit_id FROM stories WHERE id = ?", (story_id,)).fetchone()
+            if row:
+                riverdb.bump_generation(self.conn, riverdb.stories_generation(row[0]))
+        self.conn.execute("DELETE FROM autodisc_queue WHERE story_id = ?", (story_id,))
+
+    def postpone(self, story_id, next_attempt):
+        """ Schedules a story for its next attempt at next_attempt, without
+        counting an attempt (its url failed for another story) """
+        self.conn.execute("UPDATE autodisc_queue SET next_attempt = ? WHERE story_id = ?",
+                          (next_attempt, story_id))
+
+    def failed(self, story_id, error):
+        """
+        Schedules a story for another attempt, config.autodisc_retry_delay
+        seconds later, doubling the delay after each attempt. After
+        config.autodisc_max_attempts attempts the story gets no mobile url.
+        Returns True if the story will be retried.
+        """
+
+        cur = self.conn.cursor()
+        cur.execute("SELECT attempts FROM autodisc_queue WHERE story_id = ?", (story_id,))
+        row = cur.fetchone()
+        attempts = (row and row[0] or 0) + 1
+        if attempts >= config.autodisc_max_attempts:
+            self.done(story_id, None)
+            return False
+
+        next_attempt = int(time.time()) + config.autodisc_retry_delay * 2 ** (attempts - 1)
+        self.conn.execute("UPDATE autodisc_queue SET attempts = ?, next_attempt = ?, last_error = ? "
+                          "WHERE story_id = ?", (attempts, next_attempt, str(error), story_id))
+        return True
+
+    def size(self):
+        """ Returns the number of queued stories """
+        return self.conn.execute("SELECT COUNT(*) FROM autodisc_queue").fetchone()[0]
@@ -14,39 +14,113 @@
 This module autodiscovers a print or mobile version
 of a page at a given URL.
 
+The rules in the config file are compiled once per process, use
+get_autodiscovery() to get the shared engine, or the thread-safe
+autodiscover(url) function. The engine is rebuilt when the config file
+changes.
+
+With config.autodisc_scan on, pages are read incrementally and fed to an
+incremental parser, which stops reading as soon as the answer is known
+(a handheld link was found, or the head is over and the best possible
+print link was found) or after config.autodisc_max_bytes bytes. Pages
+with a Content-Type which is not HTML are not read at all.
+
 Throws an AutoDiscoveryError in case of a fatal error.
 """
 
+import os
 import re
 import sys
-import socket
-import urllib2
 import urlparse
+import threading
+import httpclient
+import HTMLParser
 from BeautifulSoup import BeautifulSoup, NavigableString
 
 sys.path.append(sys.path[0] + '/../config')
 import riverconfig as config
 
-socket.setdefaulttimeout(15)
-
 version = "1.0"
 
+# REWRITE_URL host regex which is just a host name, like 'msnbc.msn.com'
+literal_host_re = re.compile(r'^[A-Za-z0-9-]+(?:\\?\.[A-Za-z0-9-]+)+$')
+
+# IGNORE_URL regexes which can't be joined into one alternation
+unjoinable_re = re.compile(r'\\[1-9]|\(\?P|\(\?[iLmsux]')
+
+# second level domains under which domains are registered, like co.uk
+second_level_domains = ('ac', 'co', 'com', 'edu', 'gov', 'net', 'org')
+
+# Content-Types of pages which are scanned for a mobile link
+html_types = ('text/html', 'application/xhtml+xml')
+
+# tags which have no end tag
+void_tags = ('area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'param')
+
 class AutoDiscoveryError(Exception):
     """ Exception which this module might throw. """
     pass
 
+def _make_sense(tag):
+    """
+    A sense maker function. Makes sense out of a tag.
+    In a sense that a href could be whacky 'javascript:...' which
+    we need to decipher.
+    """
+
+    def js_find(js):
+        """ Try to make sense of a javascript link """
+        # Examples:
+        #  javascript:printopen('/print/society/anomal/104620-disappear-0');
+        #  javascript:PopUp('you_popup','/pages/text/print.html?in_article_id=541334&in_page_id=1965','500','500','1','yes')
+
+        m = re.search(r'''(["'])(?P<href>/.+?)\1''', js)
+        if m:
+            return m.group('href').replace('&amp;', '&')
+
+        return None
+    
+    ok_starts_with = ['http://', '/', '../', './', '?']
+    try:
+        for ok in ok_starts_with:
+            if tag['href'].startswith(ok):
+                return tag['href'].replace('&amp;', '&')
+    except KeyError:
+        # there is no 'href' attribute for this tag
+        return None
+
+    # 'href' attribute is something else than a normal link,
+    # possibly javascript:
+    return js_find(tag['href'])
+
+def registrable_domain(host):
+    """
+    Returns the registrable domain of a host, for example:
+        >>> registrable_domain('www.msnbc.msn.com')
+        'msn.com'
+        >>> registrable_domain('news.bbc.co.uk:80')
+        'bbc.co.uk'
+    """
+
+    host = host.split(':')[0].rstrip('.').lower()
+    labels = host.split('.')
+    if len(labels) > 2 and labels[-2] in second_level_domains and len(labels[-1]) == 2:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
 class AutoDiscovery(object):
     """ Autodiscovers URL of a mobile version of a webpage. """
 
     dispatchers = None
 
     def __init__(self, config_file=config.autodisc_config):
-        self.lookups = []
+        self.print_links = {}
         self.rewriters = []
         self.ignores = []
         if AutoDiscovery.dispatchers is None:
             self._init_dispatchers()
         self._parse_config(config_file)
+        self._compile_rules()
 
     def _init_dispatchers(self):
         """ Inits dispatcher config directive dispatcher table. """
@@ -59,9 +133,9 @@ class AutoDiscovery(object):
 
     def _parse_config(self, config_file):
         """
-        Parses the config and populates self.lookups list with functions
-        which get called on the page to find mobile friendly version of the
-        site at url.
+        Parses the config and populates self.print_links, self.rewriters
+        and self.ignores, which are used to find mobile friendly version of
+        the site at url.
         """
 
         try:
@@ -87,8 +161,9 @@ class AutoDiscovery(object):
     def _print_link(self, data):
         """
         PRINT_LINK config directive parser. 
-        Installs a lookup method to search a page for 'print page',
-        'print this article', etc. links
+        Adds a 'print page', 'print this article', etc. link text to
+        self.print_links, which maps link texts to their priority (the
+        order they appear in the config).
         """
 
         m = re.search(r'''^["'](.+)['"]$''', data)
@@ -96,69 +171,8 @@ class AutoDiscovery(object):
             raise AutoDiscoveryError, "Invalid data passed to 'PRINT_LINK' config command"
 
         link_text = m.group(1).lower()
-
-        def make_sense(tag):
-            """
-            A sense maker function. Makes sense out of a tag.
-            In a sense that a href could be whacky 'javascript:...' which
-            we need to decipher.
-            """
-
-            def js_find(js):
-                """ Try to make sense of a javascript link """
-                # Examples:
-                #  javascript:printopen('/print/society/anomal/104620-disappear-0');
-                #  javascript:PopUp('you_popup','/pages/text/print.html?in_article_id=541334&in_page_id=1965','500','500','1','yes')
-
-                m = re.search(r'''(["'])(?P<href>/.+?)\1''', js)
-                if m:
-                    return m.group('href').replace('&amp;', '&')
-
-                return None
-            
-            ok_starts_with = ['http://', '/', '../', './', '?']
-            try:
-                for ok in ok_starts_with:
-                    if tag['href'].startswith(ok):
-                        return tag['href'].replace('&amp;', '&')
-            except KeyError:
-                # there is no 'href' attribute for this tag
-                return None
-
-            # 'href' attribute is something else than a normal link,
-            # possibly javascript:
-            return js_find(tag['href'])
-
-        def mk_print_link_lookup():
-            def print_link_lookup(tag):
-                """ Look for an 'a' tag with link_text """
-                if tag.name != 'a':
-                    return False
-
-                for sibling in tag:
-                    try:
-                        text = sibling.string.strip().lower()
-                        if text == link_text:
-                            return True
-                    except AttributeError:
-                        try:
-                            # some sites have print icons with the same alt
-                            # text as we are looking for in <a>
-                            for text in (sibling['alt'].strip().lower(),
-                                sibling['title'].strip().lower()
-                            ):
-                                if text == link_text:
-                                    return True
-                        except KeyError:
-                            continue
-                return False
-            print_link_lookup.make_sense = make_sense
-            return print_link_lookup
-       
-        # this is not nice, we are adding the same function for each string
-        # TODO: add one function which loops over all strings, rather than
-        # a function for each sting
-        self.lookups.append(mk_print_link_lookup())
+        if link_text not in self.print_links:
+            self.print_links[link_text] = len(self.print_links)
 
     def _rewrite_url(self, data):
         """
@@ -171,19 +185,21 @@ class AutoDiscovery(object):
         except ValueError:
             raise AutoDiscoveryError, "Invalid data passed to REWRITE_URL config command"
 
-        def mk_rewriter():
-            def should_rewrite(url):
-                parsed = urlparse.urlparse(url)
-                if re.search(host_re, parsed[1]): # 1 is host
-                    return True
-                return False
-            def rewrite(url):
-                url = re.sub(from_re, to_re, url)
-                return url
-            should_rewrite.rewrite = rewrite
-            return should_rewrite
+        try:
+            host_rx = re.compile(host_re)
+            from_rx = re.compile(from_re)
+        except re.error, e:
+            raise AutoDiscoveryError, "Invalid regex passed to REWRITE_URL config command: %s" % e
+
+        # Rewriters whose host regex is a plain host name are indexed by
+        # the registrable domain of that host, so that only rewriters of
+        # url's domain have to be tried.
+        #
+        domain = None
+        if literal_host_re.match(host_re):
+            domain = registrable_domain(host_re.replace('\\.', '.'))
 
-        self.rewriters.append(mk_rewriter())
+        self.rewriters.append((len(self.rewriters), domain, host_rx, from_rx, to_re))
 
     def _ignore_url(self, data):
         """
@@ -191,12 +207,63 @@ class AutoDiscovery(object):
         Installs ignore list.
         """
 
-        def ignore(url):
-            if re.search(data, url):
+        try:
+            re.compile(data)
+        except re.error, e:
+            raise AutoDiscoveryError, "Invalid regex passed to IGNORE_URL config command: %s" % e
+
+        self.ignores.append(data)
+
+    def _compile_rules(self):
+        """
+        Compiles IGNORE_URL regexes into a single alternation and indexes
+        REWRITE_URL rewriters by domain. Called once the config is parsed.
+        """
+
+        # Regexes with backreferences, named groups or inline flags can't
+        # be joined with others, they are tried one by one.
+        #
+        joinable = [ign for ign in self.ignores if not unjoinable_re.search(ign)]
+        self.ignore_rx = None
+        if joinable:
+            self.ignore_rx = re.compile('|'.join(['(?:%s)' % ign for ign in joinable]))
+        self.ignore_rxs = [re.compile(ign) for ign in self.ignores if unjoinable_re.search(ign)]
+
+        # Each domain gets its own rewriters and the rewriters with
+        # arbitrary host regexes, in config order.
+        #
+        self.generic_rewriters = [rw for rw in self.rewriters if rw[1] is None]
+        self.domain_rewriters = {}
+        for rw in self.rewriters:
+            if rw[1] is not None:
+                self.domain_rewriters.setdefault(rw[1], []).append(rw)
+        for domain, rewriters in self.domain_rewriters.items():
+            rewriters.extend(self.generic_rewriters)
+            rewriters.sort()
+
+    def _is_ignored(self, url):
+        """ Returns True if url matches any of IGNORE_URL regexes """
+
+        if self.ignore_rx and self.ignore_rx.search(url):
+            return True
+        for ignore_rx in self.ignore_rxs:
+            if ignore_rx.search(url):
                 return True
+        return False
+
+    def _rewrite(self, url):
+        """
+        Returns url rewritten by the first REWRITE_URL rewriter whose host
+        regex matches url's host, or None if there is no such rewriter.
+        """
+
+        host = urlparse.urlparse(url)[1] # 1 is host
+        rewriters = self.domain_rewriters.get(registrable_domain(host), self.generic_rewriters)
+        for index, domain, host_rx, from_rx, to_re in rewriters:
+            if host_rx.search(host):
+                return from_rx.sub(to_re, url)
+        return None
 
-        self.ignores.append(ignore)
-    
     def autodiscover(self, url):
         """
         Given a url, autodiscover mobile version of the url
@@ -205,62 +272,311 @@ class AutoDiscovery(object):
 
         # Test if the url should not be ignored
         #
-        for ign in self.ignores:
-            if ign(url):
-                return None
+        if self._is_ignored(url):
+            return None
 
         # Call the url rewriters, as they do not require
         # to fetch the content of a page.
         #
-        for rw in self.rewriters: # rw is a function
-            if rw(url):
-                url = rw.rewrite(url)
-                return url
+        rewritten = self._rewrite(url)
+        if rewritten:
+            return rewritten
+
+        if config.autodisc_scan:
+            return self._scan_page(url)
 
         content = self._get_page(url)
         soup = BeautifulSoup(content)
+        return self._find_mobile_link(soup, url)
 
-        # Lets see if the page has a
-        # <link rel="alternate" media="handheld" href="..."> tag
-        #
-        def link_finder(tag):
-            if tag.name == 'link' and tag.has_key('media') and 'handheld' in tag['media']:
-                return True
-            return False
-
-        link = soup.find(link_finder)
-        if link and link.has_key('href'):
-            return link['href']
-
-        for lookup in self.lookups: # lookup is a function
-            tag = soup.find(lookup)
-            if tag:
-                if hasattr(lookup, 'make_sense'):
-                    # A lookup function can have a 'make_sense' attribute
-                    # which is a function makes "make sense" out of a
-                    # tag. A href could be javascript link, we might need to
-                    # do a little more extraction.
-                    href = lookup.make_sense(tag)
-                    if not href:
-                        return None
-                else:
-                    href = tag['href']
-            
-                return urlparse.urljoin(url, href)
-        
-        return None
+    def _scan_page(self, url):
+        """
+        Reads the page at url chunk by chunk and feeds it to a
+        _MobileLinkScanner until the scanner is done, the page ends or
+        config.autodisc_max_bytes bytes were read. Returns the mobile URL,
+        or None.
+        """
+
+        try:
+            stream = httpclient.client.open(url, timeout=config.autodisc_timeout)
+        except httpclient.FetchError, e:
+            raise AutoDiscoveryError, e
+
+        try:
+            content_type = stream.getheader('content-type') or ''
+            content_type = content_type.split(';')[0].strip().lower()
+            if content_type and content_type not in html_types:
+                return None
+
+            scanner = _MobileLinkScanner(self.print_links)
+            read = 0
+            while not scanner.done and read < config.autodisc_max_bytes:
+                try:
+                    chunk = stream.read(min(16384, config.autodisc_max_bytes - read))
+                except httpclient.FetchError, e:
+                    raise AutoDiscoveryError, e
+                if not chunk:
+                    break
+                read += len(chunk)
+                scanner.scan(chunk)
+        finally:
+            stream.close()
+
+        return scanner.mobile_link(url)
+
+    def _find_mobile_link(self, soup, url):
+        """
+        Walks the page once, looking for a
+        <link rel="alternate" media="handheld" href="..."> tag and for
+        'a' tags with PRINT_LINK texts.
+
+        The handheld link wins, otherwise the first 'a' tag of the PRINT_LINK
+        text which comes first in the config wins. Returns the mobile URL,
+        or None.
+        """
+
+        handheld_checked = False
+        best_tag = None
+        best_rank = len(self.print_links)
+        for tag in soup.recursiveChildGenerator():
+            if isinstance(tag, NavigableString):
+                continue
+            if tag.name == 'link':
+                if not handheld_checked and tag.has_key('media') and 'handheld' in tag['media']:
+                    if tag.has_key('href'):
+                        return tag['href']
+                    # only the first handheld link is looked at
+                    handheld_checked = True
+            elif tag.name == 'a' and best_rank > 0:
+                rank = self._print_link_rank(tag)
+                if rank < best_rank:
+                    best_tag, best_rank = tag, rank
+            if handheld_checked and best_rank == 0:
+                break
+
+        if not best_tag:
+            return None
+
+        # A href could be javascript link, we might need to
+        # do a little more extraction.
+        href = _make_sense(best_tag)
+        if not href:
+            return None
+        return urlparse.urljoin(url, href)
+
+    def _print_link_rank(self, tag):
+        """
+        Returns the priority of the best PRINT_LINK text an 'a' tag has,
+        or len(self.print_links) if it has none.
+        """
+
+        rank = len(self.print_links)
+        for sibling in tag:
+            text = sibling.string
+            if text is not None:
+                texts = (text.strip().lower(),)
+            else:
+                try:
+                    # some sites have print icons with the same alt
+                    # text as we are looking for in <a>
+                    texts = (sibling['alt'].strip().lower(),
+                        sibling['title'].strip().lower())
+                except KeyError:
+                    continue
+            for text in texts:
+                if self.print_links.get(text, rank) < rank:
+                    rank = self.print_links[text]
+        return rank
 
     def _get_page(self, url):
         """ Gets and returns a web page at url """
-        request = urllib2.Request(url)
-        request.add_header('User-Agent', 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1)')
-
         try:
-            content = urllib2.urlopen(request)
-            return content.read()
-        except (urllib2.HTTPError, urllib2.URLError, socket.error, socket.sslerror), e:
+            return httpclient.client.get(url, timeout=config.autodisc_timeout)
+        except httpclient.FetchError, e:
             raise AutoDiscoveryError, e
 
+class _MobileLinkScanner(HTMLParser.HTMLParser):
+    """
+    Incremental version of AutoDiscovery._find_mobile_link. Feed it the page
+    with scan(), it sets 'done' when reading more of the page can not change
+    the result, then get the result with mobile_link().
+
+    A handheld <link> is only looked for in the head, where it belongs.
+    """
+
+    def __init__(self, print_links):
+        HTMLParser.HTMLParser.__init__(self)
+        self.print_links = print_links
+        self.done = False
+        self.in_head = True
+        self.handheld = None
+        self.handheld_checked = False
+        self.best_attrs = None
+        self.best_rank = len(print_links)
+        self.anchor = None     # attrs and texts of the 'a' tag being parsed
+        self.child = None      # the tag in 'a' tag being parsed
+        self.depth = 0         # depth of tags in self.child
+
+    def unescape(self, s):
+        # keep entities in attributes as they are, like BeautifulSoup does
+        return s
+
+    def scan(self, data):
+        try:
+            self.feed(data)
+        except HTMLParser.HTMLParseError:
+            # malformed page, go with what was found so far
+            self.done = True
+
+    def mobile_link(self, url):
+        """ Returns the mobile URL found so far, or None """
+
+        if self.anchor:
+            self._end_anchor()
+        if self.handheld:
+            return self.handheld
+        if not self.best_attrs:
+            return None
+        href = _make_sense(self.best_attrs)
+        if not href:
+            return None
+        return urlparse.urljoin(url, href)
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if self.anchor is not None:
+            if tag == 'a':
+                self._end_anchor()
+            elif self.child is None:
+                self._end_text()
+                self.child = {'attrs': attrs, 'text': [], 'tags': 0}
+                self.depth = 0
+                if tag in void_tags:
+                    self._end_child()
+                else:
+                    self.depth = 1
+                return
+            else:
+                self.child['tags'] += 1
+                if tag not in void_tags:
+                    self.depth += 1
+                return
+
+        if tag == 'link':
+            if self.in_head and not self.handheld_checked and 'handheld' in attrs.get('media', ''):
+                if 'href' in attrs:
+                    self.handheld = attrs['href']
+                    self.done = True
+                # only the first handheld link is looked at
+                self.handheld_checked = True
+        elif tag == 'body':
+            self._end_head()
+        elif tag == 'a' and self.best_rank > 0:
+            self.anchor = {'attrs': attrs, 'texts': [], 'text': []}
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if self.child is not None and tag not in void_tags:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if self.child is not None:
+            self.depth -= 1
+            if self.depth == 0:
+                self._end_child()
+            elif tag != 'a':
+                return
+        if tag == 'a' and self.anchor is not None:
+            if self.child is not None:
+                self._end_child()
+            self._end_anchor()
+        elif tag == 'head':
+            self._end_head()
+
+    def handle_data(self, data):
+        if self.child is not None:
+            self.child['text'].append(data)
+        elif self.anchor is not None:
+            self.anchor['text'].append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data('&%s;' % name)
+
+    def handle_charref(self, name):
+        self.handle_data('&#%s;' % name)
+
+    def _end_head(self):
+        self.in_head = False
+        if self.best_rank == 0:
+            self.done = True
+
+    def _end_child(self):
+        """ A tag in 'a' tag ended, its text (if it has nothing else) or its
+        alt and title texts are texts of the 'a' tag """
+
+        child, self.child = self.child, None
+        if child['text'] and not child['tags']:
+            self.anchor['texts'].append(''.join(child['text']).strip().lower())
+        elif 'alt' in child['attrs'] and 'title' in child['attrs']:
+            # some sites have print icons with the same alt
+            # text as we are looking for in <a>
+            self.anchor['texts'].append(child['attrs']['alt'].strip().lower())
+            self.anchor['texts'].append(child['attrs']['title'].strip().lower())
+
+    def _end_text(self):
+        if self.anchor['text']:
+            self.anchor['texts'].append(''.join(self.anchor['text']).strip().lower())
+            self.anchor['text'] = []
+
+    def _end_anchor(self):
+        self._end_text()
+        anchor, self.anchor = self.anchor, None
+        rank = self.best_rank
+        for text in anchor['texts']:
+            if self.print_links.get(text, rank) < rank:
+                rank = self.print_links[text]
+        if rank < self.best_rank:
+            self.best_attrs, self.best_rank = anchor['attrs'], rank
+        if self.best_rank == 0 and not self.in_head:
+            self.done = True
+
+_engines = {}   # config file -> (modification time, AutoDiscovery)
+_engines_lock = threading.Lock()
+
+def get_autodiscovery(config_file=config.autodisc_config):
+    """
+    Returns the AutoDiscovery engine for config_file. The engine is built
+    once per process and is rebuilt only when modification time of the
+    config file changes.
+    """
+
+    try:
+        mtime = os.stat(config_file).st_mtime
+    except OSError, e:
+        raise AutoDiscoveryError, e
+
+    _engines_lock.acquire()
+    try:
+        cached = _engines.get(config_file)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        engine = AutoDiscovery(config_file)
+        _engines[config_file] = (mtime, engine)
+        return engine
+    finally:
+        _engines_lock.release()
+
+def autodiscover(url):
+    """
+    Given a url, autodiscover mobile version of the url with the shared
+    engine. Can be called from many threads at the same time.
+    """
+
+    return get_autodiscovery().autodiscover(url)
 
 if __name__ == "__main__":
     try:
@@ -269,8 +585,7 @@ if __name__ == "__main__":
         print "Usage: " + sys.argv[0] + ' <URL>'
         sys.exit(1)
 
-    ad = AutoDiscovery();
-    mobile_url = ad.autodiscover(url)
+    mobile_url = autodiscover(url)
 
     if not mobile_url:
         print "No mobile url was found for '%s'!" % url
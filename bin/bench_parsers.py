@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This program benchmarks parser backends (see parsers.py) on the pages
+built from html.examples/ fixtures, and checks that all backends extract
+exactly the same stories, subreddits and next page links.
+
+Exits with status 1 if the backends disagree.
+"""
+
+import sys
+import time
+import datetime
+import parsers
+
+version = "1.0"
+
+examples_dir = sys.path[0] + '/../html.examples'
+
+def read_example(name):
+    f = open(examples_dir + '/' + name)
+    content = f.read()
+    f.close()
+    return content
+
+def build_pages(repeat):
+    """ Builds a story page and a subreddit page with 'repeat' entries each,
+    followed by the next page link """
+
+    next_page = read_example('subreddit.next.page.txt')
+    story_page = read_example('story.txt') * repeat + next_page
+    subreddit_page = read_example('subreddit.entry.txt') * repeat + next_page
+    return story_page, subreddit_page
+
+def run_backend(backend, story_page, subreddit_page, now):
+    stories, story_next = backend.parse_stories(story_page, now)
+    srs, sr_next = backend.parse_subreddits(subreddit_page)
+    return {'stories': list(stories), 'story_next': story_next,
+            'subreddits': list(srs), 'subreddit_next': sr_next}
+
+def compare(name, expected, got):
+    """ Compares output of backend 'name' with the expected output
+    field for field, prints differences and returns their count """
+
+    differences = 0
+    for key in ('story_next', 'subreddit_next'):
+        if expected[key] != got[key]:
+            print "  %s: %s differs: %r != %r" % (name, key, got[key], expected[key])
+            differences += 1
+
+    for key in ('stories', 'subreddits'):
+        if len(expected[key]) != len(got[key]):
+            print "  %s: got %d %s, expected %d" % (name, len(got[key]), key, len(expected[key]))
+            differences += 1
+            continue
+        for idx, (exp, item) in enumerate(zip(expected[key], got[key])):
+            for field in sorted(set(exp) | set(item)):
+                if exp.get(field) != item.get(field):
+                    print "  %s: %s[%d]['%s'] differs: %r != %r" % (name, key, idx,
+                        field, item.get(field), exp.get(field))
+                    differences += 1
+
+    return differences
+
+def main(repeat, iterations, names):
+    story_page, subreddit_page = build_pages(repeat)
+    now = datetime.datetime.now()
+
+    print "Pages: %d story entries (%d bytes), %d subreddit entries (%d bytes), %d iterations" % (
+        repeat, len(story_page), repeat, len(subreddit_page), iterations)
+
+    outputs = []
+    for name in names:
+        try:
+            backend = parsers.get_backend(name)
+        except ImportError, e:
+            print "%-6s skipped (%s)" % (name, e)
+            continue
+
+        output = run_backend(backend, story_page, subreddit_page, now)
+        start = time.time()
+        for i in range(iterations):
+            run_backend(backend, story_page, subreddit_page, now)
+        elapsed = time.time() - start
+
+        print "%-6s %.2f ms per page pair" % (name, elapsed * 1000 / iterations)
+        outputs.append((name, output))
+
+    if not outputs:
+        print >>sys.stderr, "No backends could be run!"
+        return 1
+
+    differences = 0
+    ref_name, ref_output = outputs[0]
+    for name, output in outputs[1:]:
+        differences += compare(name, ref_output, output)
+
+    if differences:
+        print "Backends disagree: %d differences against '%s'!" % (differences, ref_name)
+        return 1
+
+    print "All backends produced the same output (%d stories, %d subreddits)" % (
+        len(ref_output['stories']), len(ref_output['subreddits']))
+    return 0
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    description = "A program by Peteris Krumins (http://www.catonmat.net)"
+    usage = "%prog [options]"
+
+    parser = OptionParser(description=description, usage=usage)
+    parser.add_option("-r", action="store", type="int", dest="repeat",
+                      default=25, help="How many entries to put on a page. Default: 25.")
+    parser.add_option("-i", action="store", type="int", dest="iterations",
+                      default=50, help="How many times to parse the pages. Default: 50.")
+    parser.add_option("-b", action="store", dest="backends", default="soup,event",
+                      help="Comma separated list of backends. Default: soup,event.")
+    options, args = parser.parse_args()
+
+    sys.exit(main(options.repeat, options.iterations, options.backends.split(',')))
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This program benchmarks how evaluation of IGNORE_URL and REWRITE_URL
+rules in autodiscovery.py scales with the number of rules.
+
+For each rule count it generates a config with that many site rules,
+evaluates a fixed set of urls with the indexed rules of AutoDiscovery and
+with a linear scan over all rules (the way rules used to be evaluated),
+checks that both give the same results and prints the time per url.
+"""
+
+import os
+import re
+import sys
+import time
+import urlparse
+import tempfile
+import autodiscovery
+
+version = "1.0"
+
+def make_config(count):
+    """ Returns config text with 'count' IGNORE_URL and REWRITE_URL rules """
+
+    lines = []
+    for i in range(count / 2):
+        lines.append(r'REWRITE_URL site%d.com /article/(\d+)$ /print/\1' % i)
+    lines.append(r'REWRITE_URL ^m\d*\.blog /(.+) /mobile/\1')
+    for i in range(count - count / 2):
+        if i % 2:
+            lines.append(r'IGNORE_URL \.ext%d$' % i)
+        else:
+            lines.append(r'IGNORE_URL ignored%d\.org' % i)
+    return '\n'.join(lines) + '\n'
+
+def make_urls(count):
+    urls = []
+    for i in range(0, count, max(1, count / 10)):
+        urls.append('http://www.site%d.com/article/%d' % (i / 2, i))
+        urls.append('http://files.example.com/file.ext%d' % (i | 1))
+        urls.append('http://ignored%d.org/story' % (i & ~1))
+    urls.append('http://m2.blog.example.com/a/post')
+    urls.append('http://www.nomatch.com/article/123')
+    urls.append('http://news.bbc.co.uk/2/hi/technology/7300123.stm')
+    return urls
+
+def linear(ad, url):
+    """ Evaluates rules one by one, like AutoDiscovery used to """
+
+    for ign in ad.ignores:
+        if re.search(ign, url):
+            return None
+    for index, domain, host_rx, from_rx, to_re in ad.rewriters:
+        if host_rx.search(urlparse.urlparse(url)[1]):
+            return from_rx.sub(to_re, url)
+    return url
+
+def indexed(ad, url):
+    if ad._is_ignored(url):
+        return None
+    return ad._rewrite(url) or url
+
+def timeit(func, ad, urls, iterations):
+    start = time.time()
+    for i in range(iterations):
+        for url in urls:
+            func(ad, url)
+    return (time.time() - start) * 1000000 / (iterations * len(urls))
+
+def main(counts, iterations):
+    print "%8s %14s %14s" % ('rules', 'linear us/url', 'indexed us/url')
+    mismatches = 0
+    for count in counts:
+        fd, path = tempfile.mkstemp()
+        os.write(fd, make_config(count))
+        os.close(fd)
+        try:
+            ad = autodiscovery.AutoDiscovery(path)
+        finally:
+            os.unlink(path)
+
+        urls = make_urls(count)
+        for url in urls:
+            if linear(ad, url) != indexed(ad, url):
+                print "Results differ for '%s': %r != %r" % (url, indexed(ad, url), linear(ad, url))
+                mismatches += 1
+
+        print "%8d %14.1f %14.1f" % (count, timeit(linear, ad, urls, iterations),
+            timeit(indexed, ad, urls, iterations))
+
+    return mismatches and 1 or 0
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    description = "A program by Peteris Krumins (http://www.catonmat.net)"
+    usage = "%prog [options]"
+
+    parser = OptionParser(description=description, usage=usage)
+    parser.add_option("-c", action="store", dest="counts", default="10,100,1000",
+                      help="Comma separated rule counts. Default: 10,100,1000.")
+    parser.add_option("-i", action="store", type="int", dest="iterations",
+                      default=20, help="How many times to evaluate the urls. Default: 20.")
+    options, args = parser.parse_args()
+
+    counts = [int(count) for count in options.counts.split(',')]
+    sys.exit(main(counts, options.iterations))
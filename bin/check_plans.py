@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This program checks that the hot queries of the website and the updaters
+use indexes.
+
+It runs EXPLAIN QUERY PLAN for each query in 'hot_queries', prints the
+plans and exits with status 1 if any of them scans the stories table (or
+any other table which is not allowed to be scanned) from start to end.
+Run it after migrate.py and after changing queries or indexes.
+"""
+
+import re
+import sys
+import queries
+from ranking import infinity_position
+from pysqlite2 import dbapi2 as sqlite
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+# (name, query, parameters), the query texts are the ones the website and
+# the updaters run (queries.py)
+hot_queries = [
+    ("river page", queries.river_page, (0, 26, 0)),
+] + [
+    ("river page %s a story, seek %d" % (direction, i + 1),
+     queries.river_seek % seek, (0,) + (infinity_position, 0, 0)[:3 - i] + (26,))
+    for direction in ('after', 'before')
+    for i, seek in enumerate(queries.keyset_seeks[direction])
+] + [
+    ("top users", queries.top_users, (0, 10)),
+    ("top stories", queries.top_stories, (0, 0, 15)),
+    ("generations", queries.generations, ()),
+    ("subreddit list", queries.active_subreddits, ()),
+    ("updater: known stories of a snapshot", queries.snapshot_stories, (0,)),
+    ("updater: ranked stories of a snapshot", queries.snapshot_order, (0,)),
+    ("updater: stories below the scraped depth", queries.deep_stories, (0, 25, infinity_position)),
+    ("updater: user stats", queries.count_user_stories, (1, 0, 'user')),
+    ("story velocity", queries.story_velocity, (0, 0, infinity_position)),
+]
+
+# tables which are small enough to be scanned
+scannable_tables = ('subreddits', 'generations', 'snapshot')
+
+# 'SCAN TABLE stories AS st' in older SQLite versions, 'SCAN st' in newer
+scan_re = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?')
+
+def full_scans(conn, query, params):
+    """ Returns a list of plan lines of query which scan a table from start to end """
+
+    aliases = dict([(alias, table) for table, alias in
+                    re.findall(r'(?:FROM|JOIN)\s+(\w+)\s+(?!WHERE|LEFT|JOIN|ON|ORDER|GROUP)(\w+)', query)])
+    scans = []
+    for row in conn.execute("EXPLAIN QUERY PLAN " + query, params):
+        detail = row[-1]
+        m = scan_re.match(detail)
+        if not m:
+            continue
+        table = aliases.get(m.group(1), m.group(1))
+        if table not in scannable_tables:
+            scans.append(detail)
+    return scans
+
+def main(database, verbose):
+    conn = sqlite.connect(database=database)
+    conn.execute(queries.snapshot_table)
+    failed = 0
+    for name, query, params in hot_queries:
+        if verbose:
+            print "%s:" % name
+            for row in conn.execute("EXPLAIN QUERY PLAN " + query, params):
+                print "    " + row[-1]
+        for detail in full_scans(conn, query, params):
+            print "FULL SCAN in '%s': %s" % (name, detail)
+            failed += 1
+    if failed:
+        print "%d full table scans, is the database migrated (bin/migrate.py)?" % failed
+        return 1
+    print "All %d hot queries use indexes" % len(hot_queries)
+    return 0
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    description = "A program by Peteris Krumins (http://www.catonmat.net)"
+    usage = "%prog [options]"
+
+    parser = OptionParser(description=description, usage=usage)
+    parser.add_option("-d", action="store", dest="database", default=config.database,
+                      help="Database to check. Default: riverconfig's database.")
+    parser.add_option("-v", action="store_true", dest="verbose", default=False,
+                      help="Print query plans.")
+    options, args = parser.parse_args()
+
+    sys.exit(main(options.database, options.verbose))
+
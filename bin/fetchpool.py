@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module runs fetches concurrently in a pool of worker threads and
+keeps them polite to the hosts they talk to.
+
+ * imap_unordered(func, items, workers) calls func(item) in 'workers'
+   threads and yields (item, result, exc_info) tuples as they complete,
+   so the caller (for example a single database writer) consumes results
+   in its own thread.
+ * prefetch(iterator, size) runs an iterator in a thread, so that pages
+   which can only be fetched one after another (each links to the next)
+   are fetched while the caller processes the previous ones.
+ * host_limiter is shared by all page fetchers: it allows at most
+   config.host_connections concurrent requests to a host and waits at
+   least config.host_delay seconds between starting two requests to it.
+"""
+
+import sys
+import time
+import Queue
+import urlparse
+import threading
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+class HostLimiter(object):
+    """ Per-host politeness limits """
+
+    def __init__(self, connections=2, delay=0.0):
+        self.connections = connections
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.hosts = {}     # host -> [semaphore, time of the last request]
+
+    def _host(self, url):
+        host = urlparse.urlparse(url)[1].lower()
+        self.lock.acquire()
+        try:
+            if host not in self.hosts:
+                self.hosts[host] = [threading.Semaphore(self.connections), 0]
+            return self.hosts[host]
+        finally:
+            self.lock.release()
+
+    def acquire(self, url):
+        """ Blocks until a request to url's host is allowed """
+        host = self._host(url)
+        host[0].acquire()
+        self.lock.acquire()
+        try:
+            wait = host[1] + self.delay - time.time()
+            host[1] = max(host[1] + self.delay, time.time())
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self, url):
+        self._host(url)[0].release()
+
+host_limiter = HostLimiter(config.host_connections, config.host_delay)
+
+def imap_unordered(func, items, workers):
+    """ Calls func(item) for each item in 'workers' threads. Yields
+    (item, result, exc_info) tuples in the order they complete. exc_info is
+    None if func returned normally, otherwise result is None and exc_info is
+    what sys.exc_info() returned in the worker. """
+
+    todo = Queue.Queue()
+    done = Queue.Queue()
+    for item in items:
+        todo.put(item)
+    count = todo.qsize()
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception:
+                done.put((item, None, sys.exc_info()))
+
+    for i in range(min(workers, count)):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    for i in range(count):
+        yield done.get()
+
+def prefetch(iterator, size=100):
+    """ Runs iterator in a thread and yields its items, keeping at most
+    'size' items ahead of the caller. An exception raised by the iterator
+    is re-raised in the caller's thread. If the caller stops early, the
+    thread stops after the item it is on. """
+
+    items = Queue.Queue(size)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.isSet():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception:
+            put((end, sys.exc_info()))
+
+    thread = threading.Thread(target=producer)
+    thread.setDaemon(True)
+    thread.start()
+
+    try:
+        while True:
+            item, exc_info = items.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module keeps the history of story scores and comment counts.
+
+story_history table holds (story_id, sampled, score, comments) samples.
+update_stories.py samples a story when it is inserted and whenever its
+score or comments change, so a story whose score did not change has no
+new samples. A story's score at any time is the score of its last sample
+before that time.
+
+Samples older than config.history_full_age seconds are downsampled to
+the last sample in every config.history_bucket seconds, and samples
+older than config.history_retention seconds are deleted.
+"""
+
+import sys
+import time
+import queries
+from ranking import infinity_position
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+class History(object):
+    """ Score and comment history of stories """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def record(self, samples):
+        """ Stores (story_id, sampled, score, comments) samples """
+        self.conn.executemany("INSERT OR REPLACE INTO story_history (story_id, sampled, score, comments) "
+                              "VALUES (?, ?, ?, ?)", samples)
+
+    def downsample(self, now=None):
+        """
+        Downsamples old samples and deletes expired ones. Returns a tuple of
+        the number of samples removed by downsampling and by expiry.
+        """
+
+        now = now or int(time.time())
+        full_before = now - config.history_full_age
+        keep_after = now - config.history_retention
+        bucket = config.history_bucket
+
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM story_history WHERE sampled < ? AND sampled >= ? AND EXISTS ("
+                    "  SELECT 1 FROM story_history later "
+                    "  WHERE later.story_id = story_history.story_id "
+                    "    AND later.sampled > story_history.sampled AND later.sampled < ? "
+                    "    AND later.sampled / ? = story_history.sampled / ?)",
+                    (full_before, keep_after, full_before, bucket, bucket))
+        thinned = cur.rowcount
+        cur.execute("DELETE FROM story_history WHERE sampled < ?", (keep_after,))
+        return thinned, cur.rowcount
+
+    def velocity(self, subreddit_id, window=3600, now=None):
+        """
+        Returns a dict of story id -> (score per hour, comments per hour)
+        over the last 'window' seconds (or since the story was added, if it
+        is newer) for the stories currently ranked in a subreddit.
+        """
+
+        now = now or int(time.time())
+        start = now - window
+
+        cur = self.conn.cursor()
+        cur.execute(queries.story_velocity, (start, subreddit_id, infinity_position))
+
+        velocities = {}
+        for id, score, comments, sampled, old_score, old_comments in cur.fetchall():
+            hours = (now - max(start, sampled)) / 3600.0
+            if hours <= 0:
+                velocities[id] = (0.0, 0.0)
+            else:
+                velocities[id] = ((score - old_score) / hours, (comments - old_comments) / hours)
+        return velocities
+
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module is an on-disk response cache used by httpclient.py.
+
+Each cached response is a pickled dict in its own file, named after the
+sha1 of the url it was requested at. It holds the final url (after
+redirects), ETag and Last-Modified validators, content and results that
+were derived from the content (for example parsed stories), so that a
+page which comes back '304 Not Modified' does not have to be parsed again.
+Entries which were not used for max_age seconds are pruned now and then
+(except in 'record' mode). The cache directory is created with the first
+entry. A cache which can not be read or written is reported on stderr and
+the pages are used uncached, it never fails a fetch.
+
+Cache modes:
+
+ * on     - conditional GETs for pages requested with cache=True
+ * record - like 'on', but every fetched page is stored
+ * replay - pages are served from the cache only, without any network
+"""
+
+import os
+import sys
+import time
+import errno
+import hashlib
+import tempfile
+import cPickle as pickle
+
+version = "1.0"
+
+modes = ('on', 'record', 'replay')
+
+class ResponseCache(object):
+    """ On-disk cache of responses keyed by url """
+
+    def __init__(self, directory, mode='on', max_age=None):
+        if mode not in modes:
+            raise ValueError, "Unknown cache mode '%s'" % mode
+        self.directory = directory
+        self.mode = mode
+        self.max_age = max_age
+        self.last_pruned = 0
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def load(self, url):
+        """ Returns the cache entry for url or None. The entry counts as
+        used now, so that prune() keeps it. """
+        path = self._path(url)
+        try:
+            f = open(path, 'rb')
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if self.mode == 'on':
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return entry
+
+    def store(self, url, final_url, content, etag=None, last_modified=None):
+        """ Stores a response and returns its cache entry """
+        entry = {'url': url, 'final_url': final_url, 'content': content,
+                 'etag': etag, 'last_modified': last_modified,
+                 'fetched': int(time.time()), 'parsed': {}}
+        if self.mode != 'replay':
+            self._write(entry)
+        if self.mode == 'on' and self.max_age and time.time() - self.last_pruned > self.max_age / 10:
+            self.prune()
+        return entry
+
+    def store_parsed(self, entry, key, value):
+        """ Stores a result derived from entry's content under key """
+        entry['parsed'][key] = value
+        if self.mode != 'replay':
+            self._write(entry)
+
+    def validators(self, entry):
+        """ Returns conditional request headers for a cache entry """
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def prune(self):
+        """ Deletes entries which were not used for max_age seconds (never
+        in 'record' mode, recorded pages are kept for replaying), returns
+        how many were deleted """
+
+        self.last_pruned = time.time()
+        if self.mode == 'record' or not self.max_age:
+            return 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        pruned = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < self.last_pruned - self.max_age:
+                    os.unlink(path)
+                    pruned += 1
+            except OSError:
+                pass
+        return pruned
+
+    def _write(self, entry):
+        tmp_path = None
+        try:
+            # the directory is created with the first entry, not when the
+            # cache is constructed (httpclient.py constructs it on import),
+            # by whichever fetch worker gets there first
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            # write to a temporary file and rename it, so that concurrent
+            # readers never see a half written entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(entry, f, 2)
+            finally:
+                f.close()
+            os.rename(tmp_path, self._path(entry['url']))
+        except (IOError, OSError), e:
+            print >>sys.stderr, "Could not cache %s: %s" % (entry['url'], e)
+            if tmp_path and os.path.exists(tmp_path):
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+class Page(object):
+    """ A fetched page. not_modified is True if the content came from the
+    cache (the server said '304 Not Modified', or the cache is replaying) """
+
+    def __init__(self, url, content, not_modified=False, cache=None, entry=None):
+        self.url = url
+        self.content = content
+        self.not_modified = not_modified
+        self.cache = cache
+        self.entry = entry
+
+    def parsed(self, key):
+        """ Returns the result stored with save_parsed under key, or None """
+        if self.entry:
+            return self.entry['parsed'].get(key)
+
+    def save_parsed(self, key, value):
+        """ Stores a result derived from content, if the page is cached """
+        if self.cache and self.entry:
+            self.cache.store_parsed(self.entry, key, value)
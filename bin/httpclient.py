@@ -0,0 +1,424 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module is the HTTP fetch layer shared by redditstories.py,
+subreddits.py and autodiscovery.py.
+
+It keeps a pool of keep-alive connections per host, so one update run
+reuses the same TCP connections to reddit.com across pages and
+subreddits, asks for gzip/deflate compressed responses and decompresses
+them, follows redirects, enforces a timeout and a maximum response size,
+and counts requests, bytes and latency.
+
+Use the shared 'client' instance:
+
+    content = httpclient.client.get(url)
+
+or open() a page to read it incrementally and stop reading whenever:
+
+    stream = httpclient.client.open(url)
+    try:
+        chunk = stream.read(16384)
+    finally:
+        stream.close()
+
+Pages fetched with cache=True go through the on-disk response cache (see
+httpcache.py) with conditional GETs. set_cache_mode('record') stores every
+page fetched, and set_cache_mode('replay') serves pages from the cache
+only, without any network, for reproducible offline runs.
+
+Throws a FetchError in case of an error.
+"""
+
+import sys
+import zlib
+import time
+import socket
+import httplib
+import urlparse
+import threading
+import fetchpool
+import httpcache
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+user_agent = 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1)'
+
+max_redirects = 5
+
+# how many bytes are read from a socket, and decompressed, at a time
+chunk_size = 16384
+
+class FetchError(Exception):
+    """ An exception class thrown when a page could not be fetched """
+    pass
+
+class HttpClient(object):
+    """ HTTP client with per-host keep-alive connection pools """
+
+    def __init__(self, timeout=30, max_size=2*1024*1024, pool_size=2, limiter=None, cache=None):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.pool_size = pool_size
+        self.limiter = limiter
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.pools = {}   # (scheme, host[:port]) -> list of idle connections
+        self.counters = dict.fromkeys(('requests', 'errors', 'connections',
+            'reused', 'bytes_wire', 'bytes', 'latency', 'not_modified', 'replayed'), 0)
+
+    def get(self, url, headers=None, timeout=None, cache=False):
+        """ Gets and returns a web page at url """
+        return self.get_page(url, headers, timeout, cache).content
+
+    def get_page(self, url, headers=None, timeout=None, cache=False):
+        """ Gets a web page at url, following redirects, and returns an
+        httpcache.Page. The page goes through the response cache if cache
+        is True, or if the cache is recording or replaying. """
+
+        if self.cache and (cache or self.cache.mode != 'on'):
+            return self._get_cached_page(url, headers, timeout)
+        final_url, response, content = self._follow(url, headers, timeout)
+        return httpcache.Page(final_url, content)
+
+    def _get_cached_page(self, url, headers, timeout):
+        cache = self.cache
+        entry = cache.load(url)
+        if cache.mode == 'replay':
+            if entry is None:
+                raise FetchError, "'%s' is not in the response cache" % url
+            self._count(replayed=1)
+            return httpcache.Page(entry['final_url'], entry['content'], True, cache, entry)
+
+        if entry:
+            headers = dict(headers or {})
+            headers.update(cache.validators(entry))
+        final_url, response, content = self._follow(url, headers, timeout)
+        if response.status == 304 and entry:
+            self._count(not_modified=1)
+            return httpcache.Page(entry['final_url'], entry['content'], True, cache, entry)
+
+        entry = cache.store(url, final_url, content,
+            response.getheader('etag'), response.getheader('last-modified'))
+        return httpcache.Page(final_url, content, False, cache, entry)
+
+    def open(self, url, headers=None, timeout=None):
+        """ Opens a web page at url for incremental reading, following
+        redirects. Returns a Stream, which the caller must close(). """
+
+        if self.cache and self.cache.mode != 'on':
+            # recorded and replayed pages are read in full
+            return _PageStream(self.get_page(url, headers, timeout))
+        return self._open_following(url, headers, timeout)
+
+    def _open_following(self, url, headers, timeout):
+        for i in range(max_redirects + 1):
+            stream = self._open(url, headers, timeout)
+            if stream.status in (301, 302, 303, 307):
+                location = stream.getheader('location')
+                stream.read()
+                stream.close()
+                if not location:
+                    raise FetchError, "HTTP Error %d: redirect without location" % stream.status
+                url = urlparse.urljoin(url, location)
+                continue
+            if stream.status >= 400:
+                stream.close()
+                raise FetchError, "HTTP Error %d: %s" % (stream.status, stream.reason)
+            return stream
+
+        raise FetchError, "Too many redirects"
+
+    def _follow(self, url, headers, timeout):
+        """ Gets a web page at url, following redirects. Returns a tuple of
+        the final url, the response and the content """
+
+        stream = self._open_following(url, headers, timeout)
+        try:
+            content = stream.read()
+        finally:
+            stream.close()
+        return stream.url, stream, content
+
+    def stats(self):
+        """ Returns a copy of request, byte and latency counters """
+        self.lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self.lock.release()
+
+    def print_stats(self):
+        stats = self.stats()
+        print ("HTTP: %(requests)d requests (%(errors)d errors), %(connections)d connections "
+               "opened, %(reused)d reused, %(bytes_wire)d bytes received, %(bytes)d bytes "
+               "decoded, %(latency).2fs total latency, %(not_modified)d not modified, "
+               "%(replayed)d replayed" % stats)
+
+    def close(self):
+        """ Closes all idle connections """
+        self.lock.acquire()
+        try:
+            for pool in self.pools.values():
+                for conn in pool:
+                    conn.close()
+            self.pools = {}
+        finally:
+            self.lock.release()
+
+    def _count(self, **counts):
+        self.lock.acquire()
+        try:
+            for name, value in counts.items():
+                self.counters[name] += value
+        finally:
+            self.lock.release()
+
+    def _open(self, url, headers, timeout):
+        """ Makes a single GET request and returns a Stream of its response """
+
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if scheme not in ('http', 'https'):
+            raise FetchError, "Unsupported url scheme '%s'" % scheme
+        if query:
+            path += '?' + query
+        if not path:
+            path = '/'
+        key = (scheme, host.lower())
+
+        request_headers = {'User-Agent': user_agent, 'Accept-Encoding': 'gzip, deflate'}
+        if headers:
+            request_headers.update(headers)
+
+        if self.limiter:
+            self.limiter.acquire(url)
+        start = time.time()
+        try:
+            conn, response = self._send(key, path, request_headers, timeout)
+        except (httplib.HTTPException, socket.error), e:
+            if self.limiter:
+                self.limiter.release(url)
+            self._count(requests=1, errors=1, latency=time.time() - start)
+            raise FetchError, e
+
+        return Stream(self, url, key, conn, response, start)
+
+    def _send(self, key, path, headers, timeout):
+        """ Sends a request, returns a tuple of the connection and the response """
+
+        conn, reused = self._get_connection(key, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+
+        # the server closed the kept alive connection, try a fresh one
+        conn, reused = self._get_connection(key, timeout, fresh=True)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+
+    def _get_connection(self, key, timeout, fresh=False):
+        """ Returns a tuple of a connection to host and whether it was reused """
+
+        if not fresh:
+            self.lock.acquire()
+            try:
+                pool = self.pools.get(key)
+                if pool:
+                    conn = pool.pop()
+                    self.counters['reused'] += 1
+                    if conn.sock:
+                        conn.sock.settimeout(timeout or self.timeout)
+                    return conn, True
+            finally:
+                self.lock.release()
+
+        scheme, host = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout or self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout or self.timeout)
+        self._count(connections=1)
+        return conn, False
+
+    def _put_connection(self, key, conn):
+        self.lock.acquire()
+        try:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+class Stream(object):
+    """
+    A response which is read incrementally. read() returns decoded content,
+    enforcing client's max_size. close() puts the connection back to the
+    pool if the whole response was read, otherwise closes it.
+    """
+
+    def __init__(self, client, url, key, conn, response, start):
+        self.client = client
+        self.url = url
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.start = start
+        self.status = response.status
+        self.reason = response.reason
+        self.size = 0
+        self.done = False
+        self.closed = False
+
+        encoding = (response.getheader('content-encoding') or '').lower()
+        self.decoder = None
+        if encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = _DeflateDecoder()
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, size=None):
+        """ Reads and returns a chunk of about 'size' bytes of content, or
+        all of the remaining content if size is None. Returns '' at the end. """
+
+        chunks = []
+        length = 0
+        while not self.done and (size is None or length < size):
+            chunk = self._read_chunk()
+            chunks.append(chunk)
+            length += len(chunk)
+        return ''.join(chunks)
+
+    def _read_chunk(self):
+        max_size = self.client.max_size
+        if self.size == 0:
+            length = self.response.getheader('content-length')
+            if length and length.isdigit() and int(length) > max_size:
+                self._fail("Response is too large (%s bytes)" % length)
+
+        try:
+            tail = self.decoder and self.decoder.unconsumed_tail
+            if tail:
+                wire = 0
+                data = self.decoder.decompress(tail, chunk_size)
+            else:
+                data = self.response.read(chunk_size)
+                wire = len(data)
+                if not data:
+                    self.done = True
+                    data = self.decoder and self.decoder.flush() or ''
+                elif self.decoder:
+                    data = self.decoder.decompress(data, chunk_size)
+        except (httplib.HTTPException, socket.error, zlib.error), e:
+            self._fail(e)
+
+        self.size += len(data)
+        self.client._count(bytes_wire=wire, bytes=len(data))
+        if self.size > max_size:
+            self._fail("Response is larger than %d bytes" % max_size)
+        return data
+
+    def _fail(self, error):
+        self.client._count(errors=1)
+        self.close()
+        raise FetchError, error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.done and not self.response.will_close:
+            self.client._put_connection(self.key, self.conn)
+        else:
+            self.conn.close()
+        if self.client.limiter:
+            self.client.limiter.release(self.url)
+        self.client._count(requests=1, latency=time.time() - self.start)
+
+class _PageStream(object):
+    """ Stream interface to an already fetched httpcache.Page """
+
+    status = 200
+
+    def __init__(self, page):
+        self.url = page.url
+        self.content = page.content
+
+    def getheader(self, name, default=None):
+        return default
+
+    def read(self, size=None):
+        if size is None:
+            size = len(self.content)
+        data, self.content = self.content[:size], self.content[size:]
+        return data
+
+    def close(self):
+        pass
+
+class _DeflateDecoder(object):
+    """ Decodes 'deflate' content encoding, which some servers send as a
+    zlib stream and some as a raw deflate stream """
+
+    def __init__(self):
+        self.decoder = None
+
+    def decompress(self, data, max_length=0):
+        if self.decoder is None:
+            self.decoder = zlib.decompressobj()
+            try:
+                return self.decoder.decompress(data, max_length)
+            except zlib.error:
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decoder.decompress(data, max_length)
+
+    def flush(self):
+        if self.decoder is None:
+            return ''
+        return self.decoder.flush()
+
+    def _get_unconsumed_tail(self):
+        if self.decoder is None:
+            return ''
+        return self.decoder.unconsumed_tail
+
+    unconsumed_tail = property(_get_unconsumed_tail)
+
+def set_cache_mode(mode):
+    """ Sets response cache mode of the shared client: 'off', 'on', 'record'
+    or 'replay' (see httpcache.py) """
+
+    if mode == 'off':
+        client.cache = None
+    else:
+        client.cache = httpcache.ResponseCache(config.http_cache_dir, mode,
+            config.http_cache_max_age)
+
+client = HttpClient(timeout=config.http_timeout, max_size=config.http_max_size,
+    pool_size=config.host_connections, limiter=fetchpool.host_limiter)
+set_cache_mode(config.http_cache_mode)
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This program brings the schema of an existing database up to date.
+
+The schema version is kept in SQLite's 'PRAGMA user_version' (0 for
+databases created before migrations existed). Each migration in the
+'migrations' list is applied in its own transaction together with the
+version bump, so a database is never left half migrated. db.schema.txt
+creates databases at the latest version.
+
+Throws a MigrationError in case of an error.
+"""
+
+import sys
+from autodisccache import schema as autodisc_schema
+from pysqlite2 import dbapi2 as sqlite
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+# (schema version, description, statements)
+migrations = [
+    (1, "autodiscovery cache and queue tables", autodisc_schema),
+    (2, "indexes for river pages, stats and the updaters", (
+        # river pages: WHERE subreddit_id = ? ORDER BY position, date_added DESC,
+        # and the updaters' lookups by (subreddit_id, position)
+        "CREATE INDEX IF NOT EXISTS idx_stories_river ON stories (subreddit_id, position, date_added DESC)",
+        # top stories: WHERE subreddit_id = ? AND date_reddit >= ? ORDER BY score DESC
+        "CREATE INDEX IF NOT EXISTS idx_stories_top ON stories (subreddit_id, date_reddit, score)",
+        # top users: WHERE subreddit_id = ? GROUP BY user
+        "CREATE INDEX IF NOT EXISTS idx_stories_users ON stories (subreddit_id, user)",
+    )),
+    (3, "story score and comment history", (
+        "CREATE TABLE IF NOT EXISTS story_history ("
+        "  story_id  INTEGER    NOT NULL,"
+        "  sampled   UNIX_DATE  NOT NULL,"
+        "  score     INTEGER    NOT NULL,"
+        "  comments  INTEGER    NOT NULL,"
+        "  PRIMARY KEY (story_id, sampled)"
+        ")",
+        "CREATE INDEX IF NOT EXISTS idx_story_history_sampled ON story_history (sampled)",
+    )),
+    (4, "subreddit polling schedule", (
+        "CREATE TABLE IF NOT EXISTS subreddit_schedule ("
+        "  subreddit_id  INTEGER    PRIMARY KEY,"
+        "  churn         REAL       NOT NULL,"
+        "  pages         INTEGER    NOT NULL,"
+        "  next_due      UNIX_DATE  NOT NULL,"
+        "  last_fetched  UNIX_DATE  NOT NULL"
+        ")",
+    )),
+    (5, "archive of demoted stories", (
+        "CREATE TABLE IF NOT EXISTS stories_archive ("
+        "  id             INTEGER    PRIMARY KEY,"
+        "  title          TEXT       NOT NULL,"
+        "  url            TEXT       NOT NULL,"
+        "  url_mobile     TEXT,"
+        "  reddit_id      TEXT       NOT NULL,"
+        "  subreddit_id   INTEGER    NOT NULL,"
+        "  score          INTEGER    NOT NULL,"
+        "  comments       INTEGER    NOT NULL,"
+        "  user           TEXT       NOT NULL,"
+        "  position       INTEGER    NOT NULL,"
+        "  date_reddit    UNIX_DATE  NOT NULL,"
+        "  date_added     UNIX_DATE  NOT NULL,"
+        "  date_archived  UNIX_DATE  NOT NULL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS idx_stories_archive_top ON stories_archive (subreddit_id, date_reddit, score)",
+        "CREATE INDEX IF NOT EXISTS idx_stories_archive_users ON stories_archive (subreddit_id, user)",
+    )),
+    (6, "generations of cached data", (
+        "CREATE TABLE IF NOT EXISTS generations ("
+        "  name        TEXT     PRIMARY KEY,"
+        "  generation  INTEGER  NOT NULL"
+        ")",
+    )),
+    (7, "summary tables of stats pages", (
+        "CREATE TABLE IF NOT EXISTS user_stats ("
+        "  subreddit_id  INTEGER  NOT NULL,"
+        "  user          TEXT     NOT NULL,"
+        "  stories       INTEGER  NOT NULL,"
+        "  PRIMARY KEY (subreddit_id, user)"
+        ")",
+        "CREATE INDEX IF NOT EXISTS idx_user_stats_top ON user_stats (subreddit_id, stories)",
+        "CREATE TABLE IF NOT EXISTS top_stories ("
+        "  story_id      INTEGER    PRIMARY KEY,"
+        "  subreddit_id  INTEGER    NOT NULL,"
+        "  title         TEXT       NOT NULL,"
+        "  url           TEXT       NOT NULL,"
+        "  url_mobile    TEXT,"
+        "  score         INTEGER    NOT NULL,"
+        "  comments      INTEGER    NOT NULL,"
+        "  user          TEXT       NOT NULL,"
+        "  date_reddit   UNIX_DATE  NOT NULL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS idx_top_stories_score ON top_stories (subreddit_id, score)",
+        "INSERT OR REPLACE INTO user_stats (subreddit_id, user, stories) "
+        "SELECT subreddit_id, user, COUNT(*) FROM "
+        "  (SELECT subreddit_id, user FROM stories UNION ALL "
+        "   SELECT subreddit_id, user FROM stories_archive) "
+        "GROUP BY subreddit_id, user",
+        "INSERT OR REPLACE INTO top_stories (story_id, subreddit_id, title, url, url_mobile, "
+        "  score, comments, user, date_reddit) "
+        "SELECT id, subreddit_id, title, url, url_mobile, score, comments, user, date_reddit FROM "
+        "  (SELECT id, subreddit_id, title, url, url_mobile, score, comments, user, date_reddit "
+        "   FROM stories UNION ALL "
+        "   SELECT id, subreddit_id, title, url, url_mobile, score, comments, user, date_reddit "
+        "   FROM stories_archive) "
+        "WHERE date_reddit >= CAST(strftime('%%s', 'now') AS INTEGER) - %d" % config.stats_window,
+    )),
+    (8, "drop stats indexes replaced by the summary tables", (
+        "DROP INDEX IF EXISTS idx_stories_top",
+        "DROP INDEX IF EXISTS idx_stories_users",
+        "DROP INDEX IF EXISTS idx_stories_archive_top",
+        "DROP INDEX IF EXISTS idx_stories_archive_users",
+    )),
+]
+
+latest_version = migrations[-1][0]
+
+class MigrationError(Exception):
+    """ An exception class thrown when a migration fails """
+    pass
+
+def get_version(conn):
+    """ Returns the schema version of the database """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn, target=latest_version, verbose=False):
+    """
+    Applies migrations to the database until it is at 'target' version.
+    Returns the list of versions applied.
+    """
+
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.commit()
+    conn.isolation_level = None      # transactions are handled here
+    try:
+        for migration_version, description, statements in migrations:
+            if migration_version <= get_version(conn) or migration_version > target:
+                continue
+            if verbose:
+                print "Migrating to version %d: %s" % (migration_version, description)
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute("PRAGMA user_version = %d" % migration_version)
+                cur.execute("COMMIT")
+            except sqlite.Error, e:
+                cur.execute("ROLLBACK")
+                raise MigrationError, "Migration to version %d failed: %s" % (migration_version, e)
+            applied.append(migration_version)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+def main(database, target, verbose):
+    conn = sqlite.connect(database=database, timeout=10)
+    print "Database '%s' is at schema version %d" % (database, get_version(conn))
+    try:
+        applied = migrate(conn, target, verbose)
+    except MigrationError, e:
+        print >>sys.stderr, e
+        return 1
+    if applied:
+        print "Migrated to schema version %d" % applied[-1]
+    else:
+        print "Nothing to migrate"
+    return 0
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    description = "A program by Peteris Krumins (http://www.catonmat.net)"
+    usage = "%prog [options]"
+
+    parser = OptionParser(description=description, usage=usage)
+    parser.add_option("-d", action="store", dest="database", default=config.database,
+                      help="Database to migrate. Default: riverconfig's database.")
+    parser.add_option("-t", action="store", type="int", dest="target", default=latest_version,
+                      help="Schema version to migrate to. Default: %d." % latest_version)
+    parser.add_option("-q", action="store_false", dest="verbose", default=True,
+                      help="Do not print migrations as they are applied.")
+    options, args = parser.parse_args()
+
+    sys.exit(main(options.database, options.target, options.verbose))
+
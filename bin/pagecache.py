@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module is an in-process cache of rendered pages used by the website.
+
+Each page is cached under a key (for example handler, subreddit and page
+number) together with the generation of the data it was rendered from.
+A page is rendered again when the generation changed (the updaters bump
+it, see riverdb.py), or when it is older than config.page_cache_ttl
+seconds, which keeps texts like '3 hours ago' roughly right. At most
+config.page_cache_size pages are kept, the least recently used ones are
+dropped first.
+"""
+
+import sys
+import time
+import threading
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+class PageCache(object):
+    """ LRU cache of rendered pages invalidated by generations """
+
+    def __init__(self, size=config.page_cache_size, ttl=config.page_cache_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pages = {}     # key -> [generation, time rendered, page, time used]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation, render):
+        """ Returns the page cached under key if it was rendered at
+        generation, otherwise calls render() and caches what it returns """
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.pages.get(key)
+            if entry and entry[0] == generation and now - entry[1] < self.ttl:
+                entry[3] = now
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        # rendering runs without the lock, two threads might render the
+        # same page at once, the last one is kept
+        page = render()
+
+        self.lock.acquire()
+        try:
+            self.pages[key] = [generation, now, page, now]
+            if len(self.pages) > self.size:
+                self._evict()
+        finally:
+            self.lock.release()
+        return page
+
+    def _evict(self):
+        """ Drops the least recently used tenth of the pages """
+        used = sorted([(entry[3], key) for key, entry in self.pages.items()])
+        for used_time, key in used[:max(len(used) - self.size, self.size / 10)]:
+            del self.pages[key]
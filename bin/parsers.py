@@ -0,0 +1,585 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module contains HTML parser backends which extract stories and
+subreddits from reddit pages. It is shared by redditstories.py and
+subreddits.py.
+
+Each backend has two methods:
+
+ * parse_stories(content, now=None) - returns a tuple of an iterable of
+   story dicts and the url of the next page (or None)
+ * parse_subreddits(content) - returns a tuple of an iterable of subreddit
+   dicts and the url of the next page (or None)
+
+Available backends:
+
+ * soup  - builds a BeautifulSoup tree of the page
+ * event - an event driven HTMLParser which does not build a tree at all
+
+Both backends hand the raw pieces they find to the same functions which
+turn them into dicts, so they produce exactly the same output.
+"""
+
+import re
+import time
+import datetime
+from HTMLParser import HTMLParser, HTMLParseError
+
+version = "1.0"
+
+reddit_url = 'http://reddit.com'
+
+posted_re = re.compile("posted(?:&nbsp;|\s)+(.+)(?:&nbsp;|\s)+ago") # funny nbsps
+
+class RedesignError(Exception):
+    """ An exception class thrown when it seems that Reddit has redesigned """
+    pass
+
+def get_backend(name):
+    """ Returns an instance of parser backend 'name' ('soup' or 'event') """
+
+    try:
+        return backends[name]()
+    except KeyError:
+        raise ValueError, "Unknown parser backend '%s'" % name
+
+def _make_story(raw, now=None):
+    """ Given a dict of raw pieces of a story entry found by a backend,
+    validates them and returns a story dict.
+
+    The raw dict contains the following keys:
+     * titlerow, True if titlerow div was found
+     * little, True if little div was found
+     * title_id, id attribute of title 'a' tag (None if not found)
+     * title, string of title 'a' tag
+     * href, href attribute of title 'a' tag
+     * score, string of score span (None if not found)
+     * user_href, href of user 'a' tag (None if not found)
+     * posted, the first text in little div matching posted_re (None if not found)
+     * comment, string of comment 'a' tag (None if the tag was not found)"""
+
+    if not raw['titlerow']:
+        raise RedesignError, "titlerow div was not found"
+
+    if not raw['little']:
+        raise RedesignError, "little div was not found"
+
+    if raw['title_id'] is None:
+        raise RedesignError, "title a was not found"
+
+    m = re.search(r'title_t\d_(.+)', raw['title_id'])
+    if not m:
+        raise RedesignError, "title did not contain a reddit id"
+
+    id = m.group(1)
+    if raw['title'] is None:
+        raise RedesignError, "title a did not contain text"
+    title = raw['title'].strip()
+    url = raw['href']
+    if url.startswith('/'): # link to reddit itself
+        url = 'http://reddit.com' + url
+
+    if raw['score'] is not None:
+        m = re.search(r'(\d+) point', raw['score'])
+        if not m:
+            raise RedesignError, "unable to extract score"
+        score = int(m.group(1))
+    else: # for just posted links
+        score = 0 # TODO: when this is merged into module, use redditscore to get the actual score
+
+    if raw['user_href'] is None:
+        user = '(deleted)'
+    else:
+        m = re.search('/user/(.+)/', raw['user_href'])
+        if not m:
+            raise RedesignError, "user 'a' tag did not contain href in format /user/(.+)/"
+
+        user = m.group(1)
+
+    if not raw['posted']:
+        raise RedesignError, "posted ago text was not found"
+
+    m = posted_re.search(raw['posted'])
+    posted_ago = m.group(1)
+    unix_time = _ago_to_unix(posted_ago, now)
+    if not unix_time:
+        raise RedesignError, "unable to extract story date"
+    human_time = time.ctime(unix_time)
+
+    if raw['comment'] is None:
+        raise RedesignError, "no comment 'a' tag was found"
+
+    if raw['comment'] == "comment":
+        comments = 0
+    else:
+        m = re.search(r'(\d+) comment', raw['comment'])
+        if not m:
+            raise RedesignError, "comment could could not be extracted"
+        comments = int(m.group(1))
+
+    return {
+        'id': id.encode('utf8'),
+        'title': title.encode('utf8'),
+        'url': url.encode('utf8'),
+        'score': score,
+        'comments': comments,
+        'user': user.encode('utf8'),
+        'unix_time': unix_time,
+        'human_time': human_time.encode('utf8')}
+
+def _make_subreddit(raw):
+    """ Given a dict of raw pieces of a subreddit entry found by a backend,
+    validates them and returns a subreddit dict.
+
+    The raw dict contains the following keys:
+     * divs, number of divs in the entry
+     * name_a, True if 'a' tag was found in the name div
+     * name, string of name 'a' tag
+     * name_href, href attribute of name 'a' tag (None if it had none)
+     * description, string of description div ("" if there was no such div)
+     * subsc_span, True if span tag was found in subscriber div
+     * subscribers, string of the span in subscriber div"""
+
+    if raw['divs'] < 2 or raw['divs'] > 3:
+        raise RedesignError, "Less than 2 or more than 3 divs per subreddit entry"
+
+    if not raw['name_a']:
+        raise RedesignError, "'a' tag was not found in subreddit's name"
+
+    name = raw['name']
+
+    if raw['name_href'] is None:
+        raise RedesignError, "Name's 'a' tag did not have a 'href' attribute"
+
+    m = re.search('/r/(.+)/', raw['name_href'])
+    if not m:
+        raise RedesignError, "Name's 'a' href did not contain subreddit's short name"
+
+    reddit_name = m.group(1)
+
+    if not raw['subsc_span']:
+        raise RedesignError, "Subscriber information did not contain the expected span tag"
+
+    m = re.search(r'(\d+) subscriber', raw['subscribers']);
+    if not m:
+        raise RedesignError, "Subscriber string did not contain subscriber count"
+
+    subscs = int(m.group(1))
+
+    return {
+        'name': name.encode('utf8'),
+        'reddit_name': reddit_name.encode('utf8'),
+        'description': raw['description'].encode('utf8'),
+        'subscribers': subscs}
+
+def _make_next_page(href):
+    """ Given href of the 'next' link, returns the url of the next page """
+    return reddit_url + href.replace('&amp;', '&')
+
+def _ago_to_unix(ago, now=None):
+    """ Converts reddit's 'N units' ago text to unix time, relative to
+    datetime 'now' (default: current time) """
+
+    m = re.search(r'(\d+) (\w+)', ago, re.IGNORECASE)
+    if not m:
+        return 0
+
+    delta = int(m.group(1))
+    units = m.group(2)
+
+    if not units.endswith('s'): # singular
+        units += 's' # append 's' to make it plural
+
+    if units == "months":
+        units = "days"
+        delta *= 30        # lets take 30 days in a month
+    elif units == "years":
+        units = "days"
+        delta *= 365
+
+    if now is None:
+        now = datetime.datetime.now()
+    dt = now - datetime.timedelta(**{units: delta})
+    return int(time.mktime(dt.timetuple()))
+
+class SoupBackend(object):
+    """ Parser backend which builds a BeautifulSoup tree of a page """
+
+    def __init__(self):
+        from BeautifulSoup import BeautifulSoup
+        self.BeautifulSoup = BeautifulSoup
+
+    def parse_stories(self, content, now=None):
+        soup = self.BeautifulSoup(content)
+        return self._iter_stories(soup, now), self._find_next_page(soup)
+
+    def parse_subreddits(self, content):
+        soup = self.BeautifulSoup(content)
+        return self._iter_subreddits(soup), self._find_next_page(soup)
+
+    def _iter_stories(self, soup, now):
+        """ Given a parsed HTML page, extracts all the stories and yields dicts of them.
+
+        See the 'html.examples/story.txt' for an example how HTML of an entry looks like"""
+
+        entries = soup.findAll('div', id=re.compile('entry_.*'))
+        for entry in entries:
+            raw = dict.fromkeys(('title_id', 'title', 'href', 'score',
+                'user_href', 'posted', 'comment'))
+            div_title = entry.find('div', id=re.compile('titlerow_.*'))
+            div_little = entry.find('div', attrs={'class': 'little'})
+            raw['titlerow'] = bool(div_title)
+            raw['little'] = bool(div_little)
+
+            if div_title:
+                title_a = div_title.find('a', id=re.compile('title_.*'))
+                if title_a:
+                    raw['title_id'] = title_a['id']
+                    raw['title'] = title_a.string
+                    raw['href'] = title_a['href']
+
+            if div_little:
+                score_span = div_little.find('span', id=re.compile('score_.*'))
+                if score_span:
+                    raw['score'] = score_span.string
+
+                user_a = div_little.find(lambda tag: tag.name == 'a' and tag['href'].startswith('/user/'))
+                if user_a:
+                    raw['user_href'] = user_a['href']
+
+                raw['posted'] = div_little.find(text=posted_re)
+
+                comment_a = div_little.find(lambda tag: tag.name == 'a' and tag['href'].endswith('/comments/'))
+                if comment_a:
+                    raw['comment'] = comment_a.string
+
+            yield _make_story(raw, now)
+
+    def _iter_subreddits(self, soup):
+        """ Given a parsed HTML page, extracts all the subreddits and yields dicts of them.
+
+        See the 'html.examples/subreddit.entry.txt' for an example how HTML of an entry looks like"""
+
+        entries = soup.findAll('div', id=re.compile('entry_.*'))
+        for entry in entries:
+            divs = entry.findAll('div')
+            raw = {'divs': len(divs), 'name_a': False, 'name': None,
+                   'name_href': None, 'description': "",
+                   'subsc_span': False, 'subscribers': None}
+            if 2 <= len(divs) <= 3:
+                # If anyone reads this code, I'd be happy if you gave me a mail to
+                # peter@catonmat.net and explained how else could I have parsed this
+                #
+
+                name_div = divs[0]
+                desc_div = None
+                subsc_div = None
+                if len(divs) == 3:
+                    desc_div, subsc_div = divs[1:]
+                else:
+                    subsc_div = divs[1]
+
+                name_a = name_div.find('a')
+                if name_a:
+                    raw['name_a'] = True
+                    raw['name'] = name_a.string
+                    raw['name_href'] = name_a.get('href')
+
+                if desc_div:
+                    raw['description'] = desc_div.string
+
+                subsc_span = subsc_div.find('span')
+                if subsc_span:
+                    raw['subsc_span'] = True
+                    raw['subscribers'] = subsc_span.string
+
+            yield _make_subreddit(raw)
+
+    def _find_next_page(self, soup):
+        """ Given a parsed HTML page, returns the url of the next page or None """
+        a = soup.find(lambda tag: tag.name == 'a' and tag.string == 'next')
+        if a:
+            return _make_next_page(a['href'])
+
+class _Capture(object):
+    """ Collects the text of an element the same way BeautifulSoup's
+    .string sees it: the text if the element has no child tags, None otherwise. """
+
+    def __init__(self, attrs, depth):
+        self.attrs = attrs
+        self.depth = depth
+        self.text = []
+        self.has_tags = False
+
+    def string(self):
+        text = u''.join(self.text)
+        if self.has_tags or not text:
+            return None
+        if not text.strip():
+            # BeautifulSoup collapses whitespace-only strings
+            if '\n' in text:
+                return u'\n'
+            return u' '
+        return text
+
+class _EventParser(HTMLParser):
+    """
+    Base class of event driven parsers. Keeps a stack of open tag names,
+    and calls start(tag, attrs, depth), end(tag, depth) and text(data)
+    hooks. Contiguous text (with entity references left as they are, like
+    BeautifulSoup does) is passed to text() in one piece.
+
+    Also finds the 'next' page link on the way.
+    """
+
+    void_tags = ('br', 'img', 'input', 'meta', 'link', 'hr', 'area', 'base', 'col', 'param')
+
+    def reset(self):
+        HTMLParser.reset(self)
+        self.stack = []
+        self.captures = []
+        self.pending = []
+        self.next_href = None
+
+    def unescape(self, s):
+        # leave attribute values alone, BeautifulSoup does not convert them either
+        return s
+
+    def capture(self, attrs, depth):
+        """ Starts capturing text of the element at depth """
+        c = _Capture(attrs, depth)
+        self.captures.append(c)
+        return c
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        for c in self.captures:
+            c.has_tags = True
+        attrs = dict(attrs)
+        if tag in self.void_tags:
+            self.start(tag, attrs, len(self.stack) + 1)
+            self.end(tag, len(self.stack) + 1)
+            return
+        self.stack.append(tag)
+        depth = len(self.stack)
+        if tag == 'a' and self.next_href is None and 'href' in attrs:
+            self.capture(attrs, depth).next_link = True
+        self.start(tag, attrs, depth)
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush()
+        for c in self.captures:
+            c.has_tags = True
+        attrs = dict(attrs)
+        self.start(tag, attrs, len(self.stack) + 1)
+        self.end(tag, len(self.stack) + 1)
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if tag not in self.stack:
+            return
+        while self.stack:
+            depth = len(self.stack)
+            name = self.stack.pop()
+            while self.captures and self.captures[-1].depth >= depth:
+                c = self.captures.pop()
+                if getattr(c, 'next_link', False) and c.string() == 'next' and self.next_href is None:
+                    self.next_href = c.attrs['href']
+            self.end(name, depth)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        self.pending.append(data)
+
+    def handle_entityref(self, name):
+        self.pending.append('&%s;' % name)
+
+    def handle_charref(self, name):
+        self.pending.append('&#%s;' % name)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._flush()
+        if self.stack:
+            self.handle_endtag(self.stack[0])
+
+    def _flush(self):
+        if not self.pending:
+            return
+        data = u''.join(self.pending)
+        self.pending = []
+        for c in self.captures:
+            c.text.append(data)
+        self.text(data)
+
+    def start(self, tag, attrs, depth):
+        pass
+
+    def end(self, tag, depth):
+        pass
+
+    def text(self, data):
+        pass
+
+class _StoryParser(_EventParser):
+    """ Event driven story extractor, see SoupBackend._iter_stories """
+
+    def __init__(self, now=None):
+        self.now = now
+        _EventParser.__init__(self)
+
+    def reset(self):
+        _EventParser.reset(self)
+        self.stories = []
+        self.entry = None
+
+    def start(self, tag, attrs, depth):
+        if tag == 'div' and self.entry is None:
+            if 'entry_' in attrs.get('id', ''):
+                self.entry = dict.fromkeys(('title_id', 'title', 'href', 'score',
+                    'user_href', 'posted', 'comment'))
+                self.entry.update({'titlerow': False, 'little': False})
+                self.entry_depth = depth
+                self.titlerow_depth = self.little_depth = None
+            return
+
+        if self.entry is None:
+            return
+
+        entry = self.entry
+        if tag == 'div':
+            if not entry['titlerow'] and 'titlerow_' in attrs.get('id', ''):
+                entry['titlerow'] = True
+                self.titlerow_depth = depth
+            elif not entry['little'] and 'little' in (attrs.get('class') or '').split():
+                entry['little'] = True
+                self.little_depth = depth
+        elif tag == 'a':
+            href = attrs.get('href') or ''
+            if self.titlerow_depth and entry['title_id'] is None and 'title_' in attrs.get('id', ''):
+                entry['title_id'] = attrs['id']
+                entry['href'] = href
+                entry['title'] = self.capture(attrs, depth)
+            if self.little_depth:
+                if entry['user_href'] is None and href.startswith('/user/'):
+                    entry['user_href'] = href
+                if entry['comment'] is None and href.endswith('/comments/'):
+                    entry['comment'] = self.capture(attrs, depth)
+        elif tag == 'span':
+            if self.little_depth and entry['score'] is None and 'score_' in attrs.get('id', ''):
+                entry['score'] = self.capture(attrs, depth)
+
+    def end(self, tag, depth):
+        if self.entry is None:
+            return
+        if depth == self.titlerow_depth:
+            self.titlerow_depth = None
+        elif depth == self.little_depth:
+            self.little_depth = None
+        elif depth == self.entry_depth:
+            entry = self.entry
+            self.entry = None
+            for key in ('title', 'score', 'comment'):
+                if entry[key] is not None:
+                    entry[key] = entry[key].string()
+            self.stories.append(_make_story(entry, self.now))
+
+    def text(self, data):
+        if self.entry is not None and self.little_depth and not self.entry['posted']:
+            if posted_re.search(data):
+                self.entry['posted'] = data
+
+class _SubredditParser(_EventParser):
+    """ Event driven subreddit extractor, see SoupBackend._iter_subreddits """
+
+    def reset(self):
+        _EventParser.reset(self)
+        self.subreddits = []
+        self.entry = None
+
+    def start(self, tag, attrs, depth):
+        if tag == 'div' and self.entry is None:
+            if 'entry_' in attrs.get('id', ''):
+                self.entry = []       # list of div records
+                self.open_divs = []   # div records not yet closed
+                self.entry_depth = depth
+            return
+
+        if self.entry is None:
+            return
+
+        if tag == 'div':
+            div = {'depth': depth, 'string': self.capture(attrs, depth), 'a': None, 'span': None}
+            self.entry.append(div)
+            self.open_divs.append(div)
+        elif tag in ('a', 'span'):
+            capture = None
+            for div in self.open_divs:
+                if div[tag] is None:
+                    if capture is None:
+                        capture = self.capture(attrs, depth)
+                    div[tag] = capture
+
+    def end(self, tag, depth):
+        if self.entry is None:
+            return
+        if self.open_divs and self.open_divs[-1]['depth'] == depth:
+            self.open_divs.pop()
+        elif depth == self.entry_depth:
+            divs = self.entry
+            self.entry = None
+            raw = {'divs': len(divs), 'name_a': False, 'name': None,
+                   'name_href': None, 'description': "",
+                   'subsc_span': False, 'subscribers': None}
+            if 2 <= len(divs) <= 3:
+                name_a = divs[0]['a']
+                if name_a:
+                    raw['name_a'] = True
+                    raw['name'] = name_a.string()
+                    raw['name_href'] = name_a.attrs.get('href')
+                if len(divs) == 3:
+                    raw['description'] = divs[1]['string'].string()
+                subsc_span = divs[-1]['span']
+                if subsc_span:
+                    raw['subsc_span'] = True
+                    raw['subscribers'] = subsc_span.string()
+            self.subreddits.append(_make_subreddit(raw))
+
+class EventBackend(object):
+    """ Parser backend which extracts everything in a single HTMLParser pass
+    without building a tree """
+
+    def parse_stories(self, content, now=None):
+        parser = self._feed(_StoryParser(now), content)
+        return parser.stories, parser.next_href and _make_next_page(parser.next_href)
+
+    def parse_subreddits(self, content):
+        parser = self._feed(_SubredditParser(), content)
+        return parser.subreddits, parser.next_href and _make_next_page(parser.next_href)
+
+    def _feed(self, parser, content):
+        if isinstance(content, str):
+            content = content.decode('utf8', 'replace')
+        try:
+            parser.feed(content)
+            parser.close()
+        except HTMLParseError, e:
+            raise RedesignError, "unable to parse page: %s" % e
+        return parser
+
+backends = {
+    'soup': SoupBackend,
+    'event': EventBackend
+}
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module holds the SQL of the hot queries of the website and the
+updaters.
+
+The code which runs them and bin/check_plans.py, which checks that they
+use indexes, both take the query text from here, so that the plans which
+are checked are the plans of the queries which run.
+"""
+
+version = "1.0"
+
+### website (web/redditriver.py, riverdb.py)
+
+story_columns = ("st.id id, st.position position, st.date_added date_added, "
+                 "st.title title, st.url url, st.url_mobile url_mobile, "
+                 "st.score score, st.comments comments, st.user user, "
+                 "st.date_reddit date_reddit ")
+
+# a numbered (legacy /page/N) river page: subreddit id, limit, offset
+river_page = ("SELECT " + story_columns +
+              "FROM stories st "
+              "WHERE st.subreddit_id = ? "
+              "ORDER BY st.position, st.date_added DESC, st.id "
+              "LIMIT ? "
+              "OFFSET ?")
+
+# a river page after or before a cursor story, formatted with a (condition,
+# order) of keyset_seeks: subreddit id, the cursor values, limit
+river_seek = ("SELECT " + story_columns +
+              "FROM stories st "
+              "WHERE st.subreddit_id = ? AND %s "
+              "ORDER BY %s "
+              "LIMIT ?")
+
+# Stories are ordered by (position, date_added DESC, id). The stories after
+# (or before) a cursor story are found with three index seeks, nearest
+# first: the same position and date_added with a greater id, the same
+# position with a smaller date_added, then the greater positions. So a page
+# deep down costs as much as the first one.
+#
+# direction -> ((condition, order), ...), the conditions take the first 3,
+# 2 and 1 values of the cursor (position, date_added, id).
+#
+keyset_seeks = {
+    'after':  (("st.position = ? AND st.date_added = ? AND st.id > ?", "st.id"),
+               ("st.position = ? AND st.date_added < ?", "st.date_added DESC, st.id"),
+               ("st.position > ?", "st.position, st.date_added DESC, st.id")),
+    'before': (("st.position = ? AND st.date_added = ? AND st.id < ?", "st.id DESC"),
+               ("st.position = ? AND st.date_added > ?", "st.date_added, st.id DESC"),
+               ("st.position < ?", "st.position DESC, st.date_added, st.id DESC"))
+}
+
+# the user_stats summary table is kept by update_stories.py (summary.py):
+# subreddit id, limit
+top_users = ("SELECT stories, user "
+             "FROM user_stats "
+             "WHERE subreddit_id = ? "
+             "ORDER BY stories DESC "
+             "LIMIT ? ")
+
+# the top_stories summary table holds the stories of the last
+# config.stats_window seconds (summary.py): subreddit id, since, limit
+top_stories = ("SELECT title, url, url_mobile, score, comments, user, date_reddit "
+               "FROM top_stories "
+               "WHERE subreddit_id = ? AND date_reddit >= ? "
+               "ORDER BY score DESC "
+               "LIMIT ? ")
+
+active_subreddits = "SELECT * FROM subreddits WHERE id > 0 and active = 1 ORDER by position"
+
+generations = "SELECT name, generation FROM generations"
+
+### updaters
+
+# the temp table update_stories.py loads a subreddit's scraped stories into
+snapshot_table = "CREATE TEMP TABLE IF NOT EXISTS snapshot (position INTEGER, title TEXT, url TEXT)"
+
+# known stories of the snapshot: subreddit id
+snapshot_stories = ("SELECT DISTINCT st.id, st.title, st.url, st.score, st.comments FROM snapshot sn "
+                    "JOIN stories st ON st.title = sn.title AND st.url = sn.url AND st.subreddit_id = ?")
+
+# ids of the snapshot's stories in the order they were scraped: subreddit id
+snapshot_order = ("SELECT st.id FROM snapshot sn "
+                  "JOIN stories st ON st.title = sn.title AND st.url = sn.url AND st.subreddit_id = ? "
+                  "ORDER BY sn.position")
+
+# ranked stories below the scraped depth: subreddit id, depth, infinity_position
+deep_stories = "SELECT id FROM stories WHERE subreddit_id = ? AND position > ? AND position < ?"
+
+# summary.py: stories, subreddit id, user
+count_user_stories = "UPDATE user_stats SET stories = stories + ? WHERE subreddit_id = ? AND user = ?"
+
+# The sample a story had at the start of the window (or when it was
+# added) is the last one at or before that time, found by the primary key
+# of story_history (history.py): start, subreddit id, infinity_position
+story_velocity = ("SELECT st.id, st.score, st.comments, MAX(h.sampled), h.score, h.comments "
+                  "FROM stories st "
+                  "JOIN story_history h ON h.story_id = st.id AND h.sampled <= MAX(?, st.date_added) "
+                  "WHERE st.subreddit_id = ? AND st.position < ? "
+                  "GROUP BY st.id")
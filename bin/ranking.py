@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module keeps the 'position' columns of stories and subreddits tables
+in order.
+
+Instead of swapping positions of two rows at a time, Ranking.rewrite takes
+the ids of rows in the order they were scraped, gives them positions
+1, 2, 3, ... and demotes all other rows in the same scope (a subreddit's
+stories, or all subreddits) in bulk. It runs the same few statements
+however many rows moved, and never leaves duplicate or missing positions
+among the ranked rows.
+
+The ranking is written into a temp table, which is created when Ranking is
+constructed, so that rewrite() does not commit the caller's transaction.
+"""
+
+version = "1.0"
+
+# update_stories.py keeps track of story positions accross config.story_pages reddit
+# pages. If the story is no longer found in these pages, the information about its
+# position on reddit is lost, and it is demoted to an infinity position. history.py
+# and archive.py tell the demoted stories by it.
+#
+# How big is infinity? Suppose that there are 10000 new stories on reddit daily which
+# hit the front page. If the infinity is a billion (1000000000), then it would take
+# 1000000000 / 10000 = 100000 days or 273 years to overflow this number.
+#
+infinity_position = 1000000000
+
+class Ranking(object):
+    """ Rewrites positions from ordered snapshots """
+
+    def __init__(self, conn):
+        self.conn = conn
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS ranking ("
+                     "  id        INTEGER  PRIMARY KEY,"
+                     "  position  INTEGER  NOT NULL"
+                     ")")
+
+    def rewrite(self, table, ids, scope, params=(), demote_to=None):
+        """
+        Gives rows of 'table' with 'ids' positions 1, 2, 3, ... in the order
+        of ids (a repeated id keeps its first position).
+
+        Other rows matching the 'scope' SQL condition (with 'params') are
+        demoted: to position 'demote_to' if it is given, otherwise to
+        positions after the ranked rows, in the order they were before.
+
+        Returns the number of rows whose position changed.
+        """
+
+        ranks = []
+        seen = set()
+        for id in ids:
+            if id not in seen:
+                seen.add(id)
+                ranks.append((id, len(ranks) + 1))
+
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM ranking")
+        cur.executemany("INSERT INTO ranking (id, position) VALUES (?, ?)", ranks)
+
+        if demote_to is not None:
+            cur.execute("INSERT INTO ranking (id, position) "
+                        "SELECT id, ? FROM %s WHERE %s AND id NOT IN (SELECT id FROM ranking)"
+                        % (table, scope), (demote_to,) + tuple(params))
+        else:
+            cur.execute("SELECT id FROM %s WHERE %s AND id NOT IN (SELECT id FROM ranking) "
+                        "ORDER BY position, id" % (table, scope), params)
+            demoted = [(row[0], len(ranks) + i + 1) for i, row in enumerate(cur.fetchall())]
+            cur.executemany("INSERT INTO ranking (id, position) VALUES (?, ?)", demoted)
+
+        cur.execute("UPDATE %s SET position = (SELECT r.position FROM ranking r WHERE r.id = %s.id) "
+                    "WHERE id IN (SELECT r.id FROM ranking r JOIN %s t ON t.id = r.id "
+                    "             WHERE t.position != r.position)" % (table, table, table))
+        return cur.rowcount
+
@@ -10,25 +10,19 @@
 # http://www.catonmat.net/blog/designing-redditriver-dot-com-website
 #
 
-import re
 import sys
-import time
-import socket
-import urllib2
-import datetime
-from BeautifulSoup import BeautifulSoup
+import parsers
+import httpclient
+from parsers import RedesignError
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
 
 version = "1.0"
 
 reddit_url = 'http://reddit.com'
 subreddit_url = 'http://reddit.com/r'
 
-socket.setdefaulttimeout(30)
-
-class RedesignError(Exception):
-    """ An exception class thrown when it seems that Reddit has redesigned """
-    pass
-
 class StoryError(Exception):
     """ An exception class thrown when something serious happened """
     pass
@@ -41,155 +35,52 @@ def get_stories(subreddit="front_page", pages=1, new=False):
     If new is True, gets new stories at http://reddit.com/new or
     http://reddit.com/r/subreddit/new""" 
 
-    stories = [] 
+    return list(iter_stories(subreddit, pages, new))
+
+def iter_stories(subreddit="front_page", pages=1, new=False):
+    """ Generator version of get_stories. Each page is parsed only once and
+    stories are yielded as soon as they are extracted, with 'position' and
+    'subreddit' already filled in. """
+
     if subreddit == "front_page":
         url = reddit_url
     else:
         url = subreddit_url + '/' + subreddit
     if new: url += '/new'
+    backend = parsers.get_backend(config.parser_backend)
     position = 1
     for i in range(pages):
-        content = _get_page(url)
-        entries = _extract_stories(content)
-        stories.extend(entries)
-        for story in stories:
+        # only the first page has a stable url, the urls of the next pages
+        # carry the id of the last entry of the previous page (after=...)
+        # and would fill the response cache with pages never asked again
+        page = _get_page(url, cache=(i == 0))
+        parsed = page.not_modified and page.parsed('stories')
+        if parsed:
+            # the page has not changed since it was parsed last time
+            entries, url = parsed
+        else:
+            entries, url = backend.parse_stories(page.content)
+            if page.entry:
+                entries = list(entries)
+                page.save_parsed('stories', (entries, url))
+        for story in entries:
             story['url'] = story['url'].replace('&amp;', '&')
             story['position'] = position
             story['subreddit'] = subreddit
             position += 1
-        url = _get_next_page(content)
+            yield story
         if not url:
             break
 
-    return stories;
-
-def _extract_stories(content):
-    """Given an HTML page, extracts all the stories and returns a list of dicts of them.
-    
-    See the 'html.examples/story.entry.txt' for an example how HTML of an entry looks like"""
-
-    stories = []
-    soup = BeautifulSoup(content)
-    entries = soup.findAll('div', id=re.compile('entry_.*'))
-    for entry in entries:
-        div_title = entry.find('div', id=re.compile('titlerow_.*'));
-        if not div_title:
-            raise RedesignError, "titlerow div was not found"
-
-        div_little = entry.find('div', attrs={'class': 'little'});
-        if not div_little:
-            raise RedesignError, "little div was not found"
-
-        title_a = div_title.find('a', id=re.compile('title_.*'))
-        if not title_a:
-            raise RedesignError, "title a was not found"
-
-        m = re.search(r'title_t\d_(.+)', title_a['id'])
-        if not m:
-            raise RedesignError, "title did not contain a reddit id"
-
-        id = m.group(1)
-        title = title_a.string.strip()
-        url = title_a['href']
-        if url.startswith('/'): # link to reddit itself
-            url = 'http://reddit.com' + url
-
-        score_span = div_little.find('span', id=re.compile('score_.*'))
-        if score_span:
-            m = re.search(r'(\d+) point', score_span.string)
-            if not m:
-                raise RedesignError, "unable to extract score"
-            score = int(m.group(1))
-        else: # for just posted links
-            score = 0 # TODO: when this is merged into module, use redditscore to get the actual score
-       
-        user_a = div_little.find(lambda tag: tag.name == 'a' and tag['href'].startswith('/user/'))
-        if not user_a:
-            user = '(deleted)'
-        else:
-            m = re.search('/user/(.+)/', user_a['href'])
-            if not m:
-                raise RedesignError, "user 'a' tag did not contain href in format /user/(.+)/"
-
-            user = m.group(1)
-
-        posted_re = re.compile("posted(?:&nbsp;|\s)+(.+)(?:&nbsp;|\s)+ago") # funny nbsps
-        posted_text = div_little.find(text = posted_re)
-        if not posted_text:
-            raise RedesignError, "posted ago text was not found"
-
-        m = posted_re.search(posted_text);
-        posted_ago = m.group(1)
-        unix_time = _ago_to_unix(posted_ago)
-        if not unix_time:
-            raise RedesignError, "unable to extract story date"
-        human_time = time.ctime(unix_time)
-
-        comment_a = div_little.find(lambda tag: tag.name == 'a' and tag['href'].endswith('/comments/'))
-        if not comment_a:
-            raise RedesignError, "no comment 'a' tag was found"
-
-        if comment_a.string == "comment":
-            comments = 0
-        else:
-            m = re.search(r'(\d+) comment', comment_a.string)
-            if not m:
-                raise RedesignError, "comment could could not be extracted"
-            comments = int(m.group(1))
-
-        stories.append({
-            'id': id.encode('utf8'),
-            'title': title.encode('utf8'),
-            'url': url.encode('utf8'),
-            'score': score,
-            'comments': comments,
-            'user': user.encode('utf8'),
-            'unix_time': unix_time,
-            'human_time': human_time.encode('utf8')})
-
-    return stories
-
-def _ago_to_unix(ago):
-    m = re.search(r'(\d+) (\w+)', ago, re.IGNORECASE)
-    if not m:
-        return 0
-
-    delta = int(m.group(1))
-    units = m.group(2)
-
-    if not units.endswith('s'): # singular
-        units += 's' # append 's' to make it plural
-
-    if units == "months":
-        units = "days"
-        delta *= 30        # lets take 30 days in a month
-    elif units == "years":
-        units = "days"
-        delta *= 365
-
-    dt = datetime.datetime.now() - datetime.timedelta(**{units: delta})
-    return int(time.mktime(dt.timetuple()))
-
-def _get_page(url):
-    """ Gets and returns a web page at url """
-
-    request = urllib2.Request(url)
-    request.add_header('User-Agent', 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1)')
+def _get_page(url, cache=True):
+    """ Gets a web page at url (through the response cache if cache is
+    True), returns an httpcache.Page """
 
     try:
-        response = urllib2.urlopen(request)
-        content = response.read()
-    except (urllib2.HTTPError, urllib2.URLError, socket.error, socket.sslerror), e:
+        return httpclient.client.get_page(url, cache=cache)
+    except httpclient.FetchError, e:
         raise StoryError, e
 
-    return content
-
-def _get_next_page(content):
-    soup = BeautifulSoup(content)
-    a = soup.find(lambda tag: tag.name == 'a' and tag.string == 'next')
-    if a:
-        return reddit_url + a['href']
-
 def print_stories_paragraph(stories):
     """ Given a list of dictionaries of stories, prints them out paragraph at a time. """
     
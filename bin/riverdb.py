@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module is the database access layer shared by the updaters in bin/
+and the website in web/.
+
+The database runs in WAL mode, so readers read the last committed data
+while an updater is writing, and the updater does not wait for readers.
+
+ * check_schema() exits with a message to run bin/migrate.py if the
+   database is not at the latest schema version. connect() checks it, and
+   the website checks it when it starts.
+ * connect() returns a writer connection for the updaters, with writer
+   pragmas (synchronous=NORMAL, which is safe with WAL, and a larger cache).
+ * query(sql, params) runs a read query with the calling thread's
+   long-lived read connection (query_only, memory mapped) and returns the
+   rows as Row objects. Each connection keeps
+   config.db_cached_statements prepared statements, so queries with bound
+   parameters are parsed and planned once per connection.
+ * Generations: updaters bump_generation() of what they changed (for
+   example 'subreddits', or stories_generation(subreddit_id)) in the same
+   transaction as the change, readers compare get_generation() with the
+   generation their in-process copy was built from. Readers read all
+   generations at most every config.generation_check_interval seconds.
+ * subreddit_ids() returns the reddit_name -> id map of subreddits, which
+   is reloaded only when the 'subreddits' generation changes.
+"""
+
+import sys
+import time
+import threading
+import queries
+from pysqlite2 import dbapi2 as sqlite
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+writer_pragmas = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', config.db_writer_cache_size),
+)
+
+reader_pragmas = (
+    ('query_only', 1),
+    ('cache_size', config.db_reader_cache_size),
+    ('mmap_size', config.db_mmap_size),
+)
+
+class Row(dict):
+    """ A result row, its columns can be accessed as attributes and more
+    attributes can be set (like web.py's Storage) """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError, name
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+def _set_pragmas(conn, pragmas):
+    for name, value in pragmas:
+        conn.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+
+def check_schema(database=config.database, conn=None):
+    """ Exits the program if the database needs migrating """
+
+    # imported here, migrate.py imports modules which import this one
+    from migrate import get_version, latest_version
+
+    if conn is None:
+        conn = sqlite.connect(database=database, timeout=10)
+        try:
+            schema_version = get_version(conn)
+        finally:
+            conn.close()
+    else:
+        schema_version = get_version(conn)
+    if schema_version < latest_version:
+        sys.exit("Database '%s' is at schema version %d, version %d is needed. "
+                 "Run bin/migrate.py!" % (database, schema_version, latest_version))
+
+def connect(database=config.database):
+    """ Returns a new writer connection """
+
+    conn = sqlite.connect(database=database, timeout=10,
+        cached_statements=config.db_cached_statements)
+    check_schema(database, conn)
+    conn.row_factory = sqlite.Row
+    _set_pragmas(conn, writer_pragmas)
+    return conn
+
+_local = threading.local()
+
+def get_reader(database=config.database):
+    """ Returns the read connection of the calling thread """
+
+    readers = _local.__dict__.setdefault('readers', {})
+    conn = readers.get(database)
+    if conn is None:
+        conn = sqlite.connect(database=database, timeout=10,
+            cached_statements=config.db_cached_statements)
+        _set_pragmas(conn, reader_pragmas)
+        readers[database] = conn
+    return conn
+
+def query(sql, params=(), database=config.database):
+    """ Runs a read query and returns a list of Row objects """
+
+    cur = get_reader(database).cursor()
+    cur.execute(sql, params)
+    names = [column[0] for column in cur.description]
+    return [Row(zip(names, row)) for row in cur.fetchall()]
+
+
+def bump_generation(conn, name):
+    """ Bumps the generation 'name' with the writer connection conn, in the
+    caller's transaction """
+
+    conn.execute("INSERT OR IGNORE INTO generations (name, generation) VALUES (?, 0)", (name,))
+    conn.execute("UPDATE generations SET generation = generation + 1 WHERE name = ?", (name,))
+
+def stories_generation(subreddit_id):
+    """ Returns the name of the generation of a subreddit's stories """
+    return 'stories/%d' % subreddit_id
+
+_generations = {}       # database -> (time read, {name: generation})
+
+def get_generation(name, database=config.database):
+    """ Returns the current generation 'name', 0 if it was never bumped """
+
+    cached = _generations.get(database)
+    if cached is None or time.time() - cached[0] >= config.generation_check_interval:
+        rows = query(queries.generations, (), database)
+        cached = (time.time(), dict([(row.name, row.generation) for row in rows]))
+        _generations[database] = cached
+    return cached[1].get(name, 0)
+
+_subreddit_ids = {}     # database -> (generation, {reddit_name: id})
+
+def subreddit_ids(database=config.database):
+    """ Returns a dict mapping reddit_name of all subreddits to their id """
+
+    generation = get_generation('subreddits', database)
+    cached = _subreddit_ids.get(database)
+    if cached is None or cached[0] != generation:
+        rows = query("SELECT id, reddit_name FROM subreddits", (), database)
+        cached = (generation, dict([(row.reddit_name, row.id) for row in rows]))
+        _subreddit_ids[database] = cached
+    return cached[1]
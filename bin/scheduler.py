@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module decides which subreddits update_stories.py fetches on a run,
+and how many pages of each.
+
+For each subreddit it keeps the churn it observed (new stories and
+position changes per fetched story, smoothed over runs) in
+subreddit_schedule table. A busy subreddit is fetched every
+config.schedule_min_interval seconds with config.story_pages pages, a
+quiet one every config.schedule_max_interval seconds with one page, and
+the others in between. A run fetches at most config.schedule_budget pages,
+the most overdue subreddits first, the rest wait for the next run.
+"""
+
+import sys
+import time
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+# how much the last run weighs in the smoothed churn
+churn_weight = 0.3
+
+class Scheduler(object):
+    """ Adaptive per-subreddit polling schedule """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def due(self, subreddits, now=None):
+        """
+        Given a list of subreddit rows, returns a list of (subreddit, pages)
+        to fetch now, within the page budget. Subreddits which were never
+        fetched are due at once with config.story_pages pages.
+        """
+
+        now = now or int(time.time())
+        schedule = {}
+        for row in self.conn.execute("SELECT subreddit_id, next_due, pages FROM subreddit_schedule"):
+            schedule[row[0]] = (row[1], row[2])
+
+        due = []
+        for subreddit in subreddits:
+            next_due, pages = schedule.get(subreddit['id'], (0, config.story_pages))
+            if next_due <= now:
+                due.append((next_due, subreddit['id'], subreddit, pages))
+        due.sort()
+
+        fetch = []
+        budget = config.schedule_budget
+        for next_due, id, subreddit, pages in due:
+            if pages > budget:
+                break
+            budget -= pages
+            fetch.append((subreddit, pages))
+        return fetch
+
+    def observe(self, subreddit_id, stories, changes, now=None):
+        """
+        Records that a fetch of a subreddit got 'stories' stories, of which
+        'changes' were new or moved, and schedules its next fetch.
+        """
+
+        now = now or int(time.time())
+        churn = float(changes) / max(stories, 1)
+        row = self.conn.execute("SELECT churn FROM subreddit_schedule WHERE subreddit_id = ?",
+            (subreddit_id,)).fetchone()
+        if row:
+            churn = churn_weight * churn + (1 - churn_weight) * row[0]
+
+        busyness = min(churn / config.schedule_busy_churn, 1.0)
+        interval = int(config.schedule_max_interval -
+                       (config.schedule_max_interval - config.schedule_min_interval) * busyness)
+        pages = 1 + int(round((config.story_pages - 1) * busyness))
+
+        self.conn.execute("INSERT OR REPLACE INTO subreddit_schedule "
+                          "(subreddit_id, churn, pages, next_due, last_fetched) VALUES (?, ?, ?, ?, ?)",
+                          (subreddit_id, churn, pages, now + interval, now))
+        return interval, pages
+
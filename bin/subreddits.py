@@ -10,23 +10,19 @@
 # http://www.catonmat.net/blog/designing-redditriver-dot-com-website
 #
 
-import re
 import sys
-import socket
-import urllib2
-from BeautifulSoup import BeautifulSoup
+import parsers
+import httpclient
+from parsers import RedesignError
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
 
 version = "1.0"
 
 reddit_url = 'http://reddit.com'
 subreddits_url = 'http://reddit.com/reddits'
 
-socket.setdefaulttimeout(30)
-
-class RedesignError(Exception):
-    """ An exception class thrown when it seems that Reddit has redesigned """
-    pass
-
 class SubRedditError(Exception):
     """ An exception class thrown when something serious happened """
 
@@ -44,108 +40,46 @@ def get_subreddits(pages=1, new=False):
                      'Yeah reddit, you finally got it. Context appreciated.'
      * subscribers, number of subscribers, for example, 10682"""
      
-    srs = [] 
+    return list(iter_subreddits(pages, new))
+
+def iter_subreddits(pages=1, new=False):
+    """ Generator version of get_subreddits. Subreddits are yielded as soon
+    as a page is parsed, with 'position' already filled in. """
+
     url = subreddits_url
     if new: url += '/new'
+    backend = parsers.get_backend(config.parser_backend)
     position = 1
     for i in range(pages):
-        content = _get_page(url)
-        entries = _extract_subreddits(content)
+        # only the first page has a stable url, the urls of the next pages
+        # carry the id of the last entry of the previous page (after=...)
+        # and would fill the response cache with pages never asked again
+        page = _get_page(url, cache=(i == 0))
+        parsed = page.not_modified and page.parsed('subreddits')
+        if parsed:
+            # the page has not changed since it was parsed last time
+            entries, url = parsed
+        else:
+            entries, url = backend.parse_subreddits(page.content)
+            if page.entry:
+                entries = list(entries)
+                page.save_parsed('subreddits', (entries, url))
         for entry in entries:
             entry['position'] = position
             position += 1
-        srs.extend(entries)
-        url = _get_next_page(content)
+            yield entry
         if not url:
             break
 
-    return srs;
-
-def _extract_subreddits(content):
-    """Given an HTML page, extracts all the subreddits and returns a list of dicts of them.
-    
-    See the 'html.examples/subreddit.entry.txt' for an example how HTML of an entry looks like"""
-
-    subreddits = []
-    soup = BeautifulSoup(content)
-    entries = soup.findAll('div', id=re.compile('entry_.*'))
-    for entry in entries:
-        divs = entry.findAll('div')
-        if len(divs) < 2 or len(divs) > 3:
-            raise RedesignError, "Less than 2 or more than 3 divs per subreddit entry"
-
-        # If anyone reads this code, I'd be happy if you gave me a mail to
-        # peter@catonmat.net and explained how else could I have parsed this
-        #
-
-        name_div = divs[0]
-        desc_div = None
-        subsc_div = None
-        if len(divs) == 3:
-            desc_div, subsc_div = divs[1:]
-        else:
-            subsc_div = divs[1]
-
-        name_a = name_div.find('a')
-        if not name_a:
-            raise RedesignError, "'a' tag was not found in subreddit's name"
-
-        name = name_a.string
-
-        try:
-            name_href = name_a['href']
-        except KeyError:
-            raise RedesignError, "Name's 'a' tag did not have a 'href' attribute"
-
-        m = re.search('/r/(.+)/', name_href)
-        if not m:
-            raise RedesignError, "Name's 'a' href did not contain subreddit's short name"
-
-        reddit_name = m.group(1)
-
-        desc = ""
-        if desc_div:
-            desc = desc_div.string
-
-        subsc_span = subsc_div.find('span');
-        if not subsc_span:
-            raise RedesignError, "Subscriber information did not contain the expected span tag"
-
-        subscs = subsc_span.string
-        m = re.search(r'(\d+) subscriber', subscs);
-        if not m:
-            raise RedesignError, "Subscriber string did not contain subscriber count"
-
-        subscs = int(m.group(1))
-
-        subreddits.append({
-            'name': name.encode('utf8'),
-            'reddit_name': reddit_name.encode('utf8'),
-            'description': desc.encode('utf8'),
-            'subscribers': subscs})
-
-    return subreddits
-
-def _get_page(url):
-    """ Gets and returns a web page at url """
-
-    request = urllib2.Request(url)
-    request.add_header('User-Agent', 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1)')
+def _get_page(url, cache=True):
+    """ Gets a web page at url (through the response cache if cache is
+    True), returns an httpcache.Page """
 
     try:
-        response = urllib2.urlopen(request)
-        content = response.read()
-    except (urllib2.HTTPError, urllib2.URLError, socket.error, socket.sslerror), e:
+        return httpclient.client.get_page(url, cache=cache)
+    except httpclient.FetchError, e:
         raise SubRedditError, e
 
-    return content
-
-def _get_next_page(content):
-    soup = BeautifulSoup(content)
-    a = soup.find(lambda tag: tag.name == 'a' and tag.string == 'next')
-    if a:
-        return reddit_url + a['href']
-
 def print_subreddits_paragraph(srs):
     """ Given a list of dictionaries of subreddits (srs), prints them out
     paragraph at a time:
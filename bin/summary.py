@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module keeps the summary tables the website's stats pages read.
+
+ * user_stats holds the number of stories of each user in each subreddit
+   (all time, archived stories included). It only grows: stories are
+   counted when they are inserted and are never deleted, only archived.
+ * top_stories holds the stories posted in the last config.stats_window
+   seconds, with everything the stats page shows of them. Their scores
+   and comments are updated together with the stories, and the stories
+   which got older than the window are expired on every run.
+
+update_stories.py maintains both in the same transaction as the stories,
+the autodiscovery queue sets url_mobile of top stories, and
+bin/migrate.py fills them for an existing database.
+"""
+
+import sys
+import time
+import queries
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+top_columns = "story_id, subreddit_id, title, url, url_mobile, score, comments, user, date_reddit"
+
+class StatsSummary(object):
+    """ Summary tables of stats pages """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def add(self, stories, now=None):
+        """ Counts new (story_id, subreddit_id, user) stories in user stats
+        and adds the ones posted within the stats window to top stories,
+        a story given more than once is counted once """
+
+        now = now or int(time.time())
+        stories = dict([(story[0], story) for story in stories]).values()
+        counts = {}
+        for story_id, subreddit_id, user in stories:
+            counts[(subreddit_id, user)] = counts.get((subreddit_id, user), 0) + 1
+
+        cur = self.conn.cursor()
+        cur.executemany("INSERT OR IGNORE INTO user_stats (subreddit_id, user, stories) VALUES (?, ?, 0)",
+                        counts.keys())
+        cur.executemany(queries.count_user_stories,
+                        [(count, subreddit_id, user) for (subreddit_id, user), count in counts.items()])
+        cur.executemany("INSERT OR REPLACE INTO top_stories (%s) "
+                        "SELECT id, subreddit_id, title, url, url_mobile, score, comments, user, date_reddit "
+                        "FROM stories WHERE id = ? AND date_reddit >= ?" % top_columns,
+                        [(story[0], now - config.stats_window) for story in stories])
+
+    def update(self, scores):
+        """ Updates top stories from (story_id, score, comments) tuples """
+        self.conn.executemany("UPDATE top_stories SET score = ?, comments = ? WHERE story_id = ?",
+                              [(score, comments, id) for id, score, comments in scores])
+
+    def expire(self, now=None):
+        """ Removes top stories older than the stats window, returns how many """
+        now = now or int(time.time())
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM top_stories WHERE date_reddit < ?", (now - config.stats_window,))
+        return cur.rowcount
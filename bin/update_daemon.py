@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This program runs update_subreddits.py, update_stories.py and
+update_mobile.py on timers in one long-running process, instead of
+starting them from cron.
+
+Modules, the autodiscovery rules, keep-alive connections and the database
+connection stay loaded between runs. The program holds the lock files of
+all three updaters (and its own), so neither a second daemon nor a cron
+run of an updater can run at the same time.
+
+The current job, and the start, duration and result of the last run of
+each job, are written to config.daemon_status_file. SIGTERM or SIGINT
+stop the daemon after the current job finishes.
+"""
+
+import os
+import sys
+import time
+import signal
+import traceback
+import riverdb
+import update_stories
+import update_subreddits
+import update_mobile
+from update_stories import Lock
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+class Job(object):
+    """ An updater which is run every 'interval' seconds """
+
+    def __init__(self, name, main, interval):
+        self.name = name
+        self.main = main
+        self.interval = interval
+        self.next_run = 0
+        self.last_start = None
+        self.last_duration = None
+        self.last_result = None
+        self.runs = 0
+
+class Daemon(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.current = None
+        self.started = int(time.time())
+        self.stopping = False
+        self.conn = riverdb.connect()
+
+    def stop(self, signum, frame):
+        print "Got signal %d, stopping after the current job" % signum
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            job = min(self.jobs, key=lambda job: job.next_run)
+            self.write_status()
+            while not self.stopping and time.time() < job.next_run:
+                # sleep in short steps, so that a signal is handled quickly
+                time.sleep(min(1, job.next_run - time.time()))
+            if self.stopping:
+                break
+            self.run_job(job)
+
+        self.current = None
+        self.write_status()
+        print "Stopped"
+
+    def run_job(self, job):
+        self.current = job
+        self.write_status()
+        print "Running %s at %s" % (job.name, time.ctime())
+        job.last_start = time.time()
+        try:
+            status = job.main(self.conn)
+            if status:
+                job.last_result = "exit status %d" % status
+            else:
+                job.last_result = "ok"
+        except Exception, e:
+            traceback.print_exc()
+            self.conn.rollback()
+            job.last_result = "error: %s" % e
+        job.last_duration = time.time() - job.last_start
+        job.runs += 1
+        job.next_run = job.last_start + job.interval
+        self.current = None
+        sys.stdout.flush()
+
+    def write_status(self):
+        """ Writes the status file, replacing it atomically """
+
+        lines = ["pid: %d" % os.getpid(),
+                 "started: %s" % time.ctime(self.started),
+                 "current job: %s" % (self.current and self.current.name or "none")]
+        for job in self.jobs:
+            if job.last_start is None:
+                lines.append("%s: not run yet" % job.name)
+            else:
+                lines.append("%s: last run %s, took %.1fs, %s, %d runs, next run %s" % (job.name,
+                    time.ctime(job.last_start), job.last_duration, job.last_result, job.runs,
+                    time.ctime(job.next_run)))
+
+        tmp_file = config.daemon_status_file + '.tmp'
+        f = open(tmp_file, 'w')
+        try:
+            f.write('\n'.join(lines) + '\n')
+        finally:
+            f.close()
+        os.rename(tmp_file, config.daemon_status_file)
+
+if __name__ == "__main__":
+    locks = []
+    for name in ('update_daemon', 'update_subreddits', 'update_stories', 'update_mobile'):
+        lock = Lock(config.lock_dir + '/' + name + '.lock')
+        if not lock.lock():
+            print "%s might be already running!" % name
+            sys.exit(1)
+        locks.append(lock)
+
+    argv = sys.argv[1:]
+    if "--noautodisc" in argv:
+        print "Setting autodiscovery to False"
+        update_stories.do_autodiscovery = False
+
+    jobs = [Job('subreddits', update_subreddits.main, config.daemon_subreddits_interval),
+            Job('stories', update_stories.main, config.daemon_stories_interval),
+            Job('mobile', update_mobile.main, config.daemon_mobile_interval)]
+    Daemon(jobs).run()
+
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This program autodiscovers mobile urls of the stories that update_stories.py
+inserted with url_mobile pending (NULL) and queued in autodisc_queue table.
+
+Queued stories are autodiscovered in config.autodisc_workers threads, at most
+config.autodisc_per_host stories of any host at a time. Stories which fail
+are retried later, and give up after config.autodisc_max_attempts attempts.
+"""
+
+import sys
+import fcntl
+import traceback
+import fetchpool
+import httpclient
+import autodiscovery
+import autodisccache
+import riverdb
+
+sys.path.append(sys.path[0] + '/../config')
+
+import riverconfig as config
+
+version = "1.0"
+
+class Lock(object):
+    """ File locking class """
+    def __init__(self, file):
+        self.file = file
+
+    def lock(self):
+        self.f = open(self.file, 'w')
+        try:
+            fcntl.lockf(self.f.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+            return True
+        except IOError, e:
+            return False
+
+# Wheter to print autodiscovery information
+# Can be set to true with --autodiscdebug command option
+autodiscdebug = False
+
+def discover(story):
+    """ Autodiscovers the mobile url of a queued story (runs in a worker thread) """
+    return autodiscovery.autodiscover(story['url'])
+
+def main(conn=None):
+    if conn is None:
+        conn = riverdb.connect()
+
+    autodisc_cache = autodisccache.AutoDiscoveryCache(conn)
+    autodisc_queue = autodisccache.AutoDiscoveryQueue(conn)
+
+    found = 0
+    not_found = 0
+    retried = 0
+    postponed = 0
+    given_up = 0
+    while True:
+        stories = autodisc_queue.get_due(config.autodisc_workers * config.autodisc_per_host,
+            config.autodisc_per_host)
+        if not stories:
+            break
+
+        # the same url might have been autodiscovered since it was queued,
+        # or might have failed for another story, then it is tried when the
+        # cached error expires (a story's own retries keep their delays)
+        to_discover = []
+        for story in stories:
+            cached = autodisc_cache.lookup(story['url'])
+            if cached and cached[0] == 'error' and story['attempts'] == 0:
+                autodisc_queue.postpone(story['story_id'], cached[2])
+                postponed += 1
+            elif cached and cached[0] != 'error':
+                autodisc_queue.done(story['story_id'], cached[1])
+                if cached[1]:
+                    found += 1
+                else:
+                    not_found += 1
+            else:
+                to_discover.append(story)
+        conn.commit()
+
+        discovered = fetchpool.imap_unordered(discover, to_discover, config.autodisc_workers)
+        for story, url_mobile, error in discovered:
+            if autodiscdebug:
+                print "Autodiscovered '%s': %s" % (story['url'], error and error[1] or url_mobile)
+            if error and not issubclass(error[0], (autodiscovery.AutoDiscoveryError, UnicodeEncodeError)):
+                # a bug rather than a bad page, but one story should not
+                # hold back the rest of the queue
+                print >>sys.stderr, "Unexpected error autodiscovering '%s':" % story['url']
+                traceback.print_exception(*error)
+                if autodisc_queue.failed(story['story_id'], error[1]):
+                    retried += 1
+                else:
+                    given_up += 1
+            elif error:
+                autodisc_cache.store(story['url'], None, error=True)
+                if autodisc_queue.failed(story['story_id'], error[1]):
+                    retried += 1
+                else:
+                    given_up += 1
+            else:
+                autodisc_cache.store(story['url'], url_mobile)
+                autodisc_queue.done(story['story_id'], url_mobile)
+                if url_mobile:
+                    found += 1
+                else:
+                    not_found += 1
+            conn.commit()
+
+    print "Autodiscovered: %d found, %d not found, %d to retry, %d postponed, %d given up" % (found,
+        not_found, retried, postponed, given_up)
+    print "%d stories are waiting for autodiscovery" % autodisc_queue.size()
+    httpclient.client.print_stats()
+    autodisc_cache.print_stats()
+
+if __name__ == "__main__":
+    lock = Lock(config.lock_dir + '/update_mobile.lock')
+    if not lock.lock():
+        print "I might be already running!"
+        sys.exit(1)
+
+    argv = sys.argv[1:]
+    if "--autodiscdebug" in argv:
+        print "Setting autodiscovery debug to True"
+        autodiscdebug = True
+    if "--record" in argv:
+        print "Recording all fetched pages in the response cache"
+        httpclient.set_cache_mode('record')
+    if "--replay" in argv:
+        print "Replaying pages from the response cache, no network"
+        httpclient.set_cache_mode('replay')
+
+    main()
+
@@ -16,10 +16,18 @@ import os
 import sys
 import time
 import fcntl
+import fetchpool
+import httpclient
 import redditstories
-import autodiscovery
+import autodisccache
+import riverdb
+import queries
+from ranking import Ranking, infinity_position
+from history import History
+from scheduler import Scheduler
+from archive import Archiver
+from summary import StatsSummary
 from itertools import izip, count
-from pysqlite2 import dbapi2 as sqlite
 
 sys.path.append(sys.path[0] + '/../config')
 
@@ -44,36 +52,168 @@ class Lock(object):
 # Can be set to false with --noautodisc command option
 do_autodiscovery = True
 
-# Wheter to print autodiscovery information
-# Can be set to true with --autodescdebug command option
-autodiscdebug = False
+# Whether to fetch all subreddits with config.story_pages pages, ignoring
+# the schedule. Can be set to true with --all command option
+fetch_all = False
 
-# This program keeps track of story positions accross config.story_pages reddit pages.
-# If the story is no longer found in these pages, the information about its
-# position on reddit is lost, and it is assigned an infinity position.
-#
-# How big is infinity? Suppose that there are 10000 new stories on reddit daily which
-# hit the front page. If the infinity is a billion (1000000000), then it would take
-# 1000000000 / 10000 = 100000 days or 273 years to overflow this number.
-# 
-infinity_position = 1000000000
-
-def main():
-    conn = sqlite.connect(database=config.database, timeout=10)
-    conn.row_factory = sqlite.Row
+def fetch_stories(item):
+    """ Fetches and parses stories of a subreddit (runs in a worker thread) """
+    subreddit, pages = item
+    return redditstories.get_stories(subreddit=subreddit['reddit_name'], pages=pages)
+
+def ingest_stories(conn, subreddit_id, stories, autodisc_cache, autodisc_queue, ranking, history,
+                   summary):
+    """
+    Stores a subreddit's scraped stories in the database in one transaction.
+
+    The stories are loaded into the 'snapshot' temp table and matched
+    against the stories table with one join. Known stories whose score or
+    comments changed are updated with executemany, new stories are
+    inserted (once, even if they were scraped twice) and tracked by the ids
+    of their inserts, and both are sampled into story history and counted
+    in the stats summary tables. Then ranking gives the stories positions
+    in the order they were scraped and demotes the subreddit's other
+    stories to infinity_position. If anything changed, the generation of
+    the subreddit's stories is bumped, so that the website renders its
+    pages again.
+
+    Returns a tuple of the number of new, updated and moved stories, and a
+    list of (phase, milliseconds) timings. Stories below the scraped depth
+    which were demoted are not counted as moved: when the scheduler fetches
+    fewer pages of a subreddit than last time, they are demoted because
+    their pages were not scraped, not because the subreddit changed.
+    """
+
+    timings = []
+    phase_start = [time.time()]
+    def phase(name):
+        now = time.time()
+        timings.append((name, (now - phase_start[0]) * 1000))
+        phase_start[0] = now
+
+    cur = conn.cursor()
+    cur.execute("DELETE FROM snapshot")
+    cur.executemany("INSERT INTO snapshot (position, title, url) VALUES (?, ?, ?)",
+        [(position, story['title'], story['url']) for position, story in izip(count(1), stories)])
+    phase('load')
+
+    known = {}          # (title, url) -> story id
+    old_scores = {}     # story id -> (score, comments) in the database
+    cur.execute(queries.snapshot_stories, (subreddit_id,))
+    for id, title, url, score, comments in cur.fetchall():
+        known[(title, url)] = id
+        old_scores[id] = (score, comments)
+    phase('match')
+
+    # a story might be scraped twice (if it moved to the next page while
+    # pages were fetched), the last time counts
+    scores = {}         # story id -> (score, comments)
+    new = {}            # (title, url) -> story
+    for position, story in izip(count(1), stories):
+        key = (story['title'], story['url'])
+        if key in known:
+            scores[known[key]] = (story['score'], story['comments'])
+        elif key in new:
+            new[key]['score'], new[key]['comments'] = story['score'], story['comments']
+        else:
+            story['position'] = position
+            story['subreddit_id'] = subreddit_id
+            new[key] = story
+
+    changed = [(id, score, comments) for id, (score, comments) in scores.items()
+               if old_scores[id] != (score, comments)]
+    cur.executemany("UPDATE stories SET score = ?, comments = ? WHERE id = ?",
+        [(score, comments, id) for id, score, comments in changed])
+
+    # Mobile urls which are not in autodiscovery cache are left NULL
+    # and autodiscovered later by update_mobile.py, so that a slow
+    # site does not hold back the stories after it. A url which failed
+    # recently is not tried again before its cached error expires.
+    #
+    date_added = int(time.time())
+    for story in new.values():
+        story['date_added'] = date_added
+        story['url_mobile'] = ""
+        story['next_attempt'] = None
+        if do_autodiscovery:
+            cached = autodisc_cache.lookup(story['url'])
+            if cached and cached[0] != 'error':
+                story['url_mobile'] = cached[1] or ""
+            else:
+                story['url_mobile'] = None
+                if cached:
+                    story['next_attempt'] = cached[2]
+    # the ids of new stories are taken from their inserts, so that what
+    # follows knows exactly which stories this run inserted
+    inserted = []       # (story id, story) of new stories
+    for story in new.values():
+        cur.execute("INSERT INTO stories (title, url, url_mobile, reddit_id, subreddit_id, "
+                    "score, comments, user, position, date_reddit, date_added) "
+                    "VALUES (:title, :url, :url_mobile, :id, :subreddit_id, :score, "
+                    ":comments, :user, :position, :unix_time, :date_added)", story)
+        inserted.append((cur.lastrowid, story))
+    phase('write')
+
+    cur.execute(queries.snapshot_order, (subreddit_id,))
+    ranked = [row[0] for row in cur.fetchall()]
+    cur.execute(queries.deep_stories, (subreddit_id, len(stories), infinity_position))
+    deep = len(set([row[0] for row in cur.fetchall()]) - set(ranked))
+    moved = ranking.rewrite('stories', ranked, 'subreddit_id = ?', (subreddit_id,),
+        demote_to=infinity_position)
+    autodisc_queue.put_many([(id, story['url'], story['next_attempt'])
+                             for id, story in inserted if story['url_mobile'] is None])
+    phase('positions')
+
+    history.record([(id, date_added, score, comments) for id, score, comments in changed] +
+                   [(id, date_added, story['score'], story['comments']) for id, story in inserted])
+    phase('history')
+
+    summary.add([(id, subreddit_id, story['user']) for id, story in inserted])
+    summary.update(changed)
+    phase('summary')
+
+    if new or changed or moved:
+        riverdb.bump_generation(conn, riverdb.stories_generation(subreddit_id))
+
+    conn.commit()
+    phase('commit')
+
+    return len(new), len(stories) - len(new), moved - deep, timings
+
+def main(conn=None):
+    if conn is None:
+        conn = riverdb.connect()
     cur = conn.cursor()
     
+    autodisc_cache = autodisccache.AutoDiscoveryCache(conn)
+    autodisc_queue = autodisccache.AutoDiscoveryQueue(conn)
+    ranking = Ranking(conn)
+    history = History(conn)
+    scheduler = Scheduler(conn)
+    archiver = Archiver(conn)
+    summary = StatsSummary(conn)
+
+    cur.execute(queries.snapshot_table)
     cur.execute("SELECT id, reddit_name FROM subreddits WHERE active = 1")
     subreddits = cur.fetchall()
+    if fetch_all:
+        scheduled = [(subreddit, config.story_pages) for subreddit in subreddits]
+    else:
+        scheduled = scheduler.due(subreddits)
 
+    # Stories are fetched and parsed in fetchpool's worker threads, while
+    # this thread is the only one writing to the database.
+    #
     total_new = 0
     total_updated = 0
-    for subreddit in subreddits:
-        new_stories = 0
-        updated_stories = 0
-        print "Going after %s's subreddit stories! " % subreddit['reddit_name']
+    print "Going after stories of %d of %d subreddits (%d workers)!" % (len(scheduled),
+        len(subreddits), config.fetch_workers)
+    fetched = fetchpool.imap_unordered(fetch_stories, scheduled, config.fetch_workers)
+    for (subreddit, pages), stories, error in fetched:
+        print "Got %s's subreddit stories! " % subreddit['reddit_name']
         try:
-            stories = redditstories.get_stories(subreddit=subreddit['reddit_name'], pages=config.story_pages)
+            if error:
+                raise error[0], error[1], error[2]
         except redditstories.RedesignError, e:
             print "Could not get stories for %s (reddit might have redesigned: %s)!" % (subreddit['reddit_name'], e)
             continue
@@ -81,65 +221,32 @@ def main():
             print "Serious error while getting %s: %s!" % (subreddit['reddit_name'], e)
             continue
 
-        for position, story in izip(count(1), stories):
-            story['position'] = position
-            story['subreddit_id'] = subreddit['id']
-            cur.execute("SELECT id, position FROM stories WHERE subreddit_id = ? AND title = ? AND url = ?",
-                (subreddit['id'], story['title'], story['url']))
-            existing_row = cur.fetchone()
-            if existing_row:
-                updated_stories += 1
-                cur.execute("UPDATE stories SET score = ?, comments = ? WHERE id = ?",
-                    (story['score'], story['comments'], existing_row['id']))
-                if existing_row['position'] != story['position']:
-                    # swap both positions to maintain consistency of positions
-                    swap_id = cur.execute("SELECT id FROM stories WHERE subreddit_id = ? AND position = ?",
-                        (subreddit['id'], position)).fetchone()[0]
-                    cur.execute("UPDATE stories SET position = ? WHERE id = ?",
-                        (story['position'], existing_row['id'])) 
-                    cur.execute("UPDATE stories SET position = ? WHERE id = ?",
-                        (existing_row['position'], swap_id))
-                    conn.commit()
-                continue
-
-            story['url_mobile'] = ""
-            if do_autodiscovery:
-                try:
-                    if autodiscdebug:
-                        print "Autodiscovering '" + story['url'] + "'"
-                    autodisc = autodiscovery.AutoDiscovery()
-                    story['url_mobile'] = autodisc.autodiscover(story['url'])
-                    if autodiscdebug:
-                        if story['url_mobile']:
-                            print "Autodiscovered '" + story['url_mobile'] + "'"
-                        else:
-                            print "Did not autodiscover anything!"
-                except (autodiscovery.AutoDiscoveryError, UnicodeEncodeError), e:
-                    if autodiscdebug:
-                        print "Failed autodiscovering: %s" % e
-                    pass
-
-            story['date_added'] = int(time.time())
-
-            story_at_pos = cur.execute("SELECT id FROM stories WHERE subreddit_id = ? AND position = ?",
-                (subreddit['id'], position)).fetchone()
-            if story_at_pos:
-                id = story_at_pos[0]
-                cur.execute("UPDATE stories SET position = ? WHERE id = ?", (infinity_position, id))
-            
-            cur.execute("INSERT INTO stories (title, url, url_mobile, reddit_id, subreddit_id, "
-                        "score, comments, user, position, date_reddit, date_added) "
-                        "VALUES (:title, :url, :url_mobile, :id, :subreddit_id, :score, "
-                        ":comments, :user, :position, :unix_time, :date_added)",
-                        story)
-            new_stories += 1
-            conn.commit()
+        new_stories, updated_stories, moved_stories, timings = ingest_stories(conn, subreddit['id'],
+            stories, autodisc_cache, autodisc_queue, ranking, history, summary)
+
+        # committed at once, so that no write transaction stays open while
+        # this thread waits for the next subreddit's stories
+        interval, next_pages = scheduler.observe(subreddit['id'], len(stories),
+            new_stories + moved_stories)
+        conn.commit()
 
         total_new += new_stories
         total_updated += updated_stories
         print "%d new and %d updated (%d total)" % (new_stories, updated_stories, new_stories + updated_stories)
+        print "Phases: " + ", ".join(["%s %.1fms" % (phase, ms) for phase, ms in timings])
+        print "Next fetch in %d minutes, %d pages" % (interval / 60, next_pages)
 
     print "Total: %d new and %d updated (%d total)" % (total_new, total_updated, total_new + total_updated)
+    thinned, expired = history.downsample()
+    archived = archiver.archive()
+    top_expired = summary.expire()
+    conn.commit()
+    print "History: %d samples downsampled, %d expired" % (thinned, expired)
+    print "Archived %d stories" % archived
+    print "Stats: %d top stories expired" % top_expired
+    httpclient.client.print_stats()
+    autodisc_cache.print_stats()
+    print "%d stories are waiting for autodiscovery" % autodisc_queue.size()
 
 if __name__ == "__main__":
     lock = Lock(config.lock_dir + '/update_stories.lock')
@@ -151,9 +258,15 @@ if __name__ == "__main__":
     if "--noautodisc" in argv:
         print "Setting autodiscovery to False"
         do_autodiscovery = False
-    if "--autodiscdebug" in argv:
-        print "Setting autodiscovery debug to True"
-        autodiscdebug = True
+    if "--all" in argv:
+        print "Fetching all subreddits, ignoring the schedule"
+        fetch_all = True
+    if "--record" in argv:
+        print "Recording all fetched pages in the response cache"
+        httpclient.set_cache_mode('record')
+    if "--replay" in argv:
+        print "Replaying pages from the response cache, no network"
+        httpclient.set_cache_mode('replay')
 
     main()
 
@@ -15,8 +15,11 @@
 import os
 import sys
 import fcntl
+import fetchpool
+import httpclient
 import subreddits
-from pysqlite2 import dbapi2 as sqlite
+import riverdb
+from ranking import Ranking
 
 sys.path.append(sys.path[0] + '/../config')
 import riverconfig as config
@@ -36,55 +39,98 @@ class Lock(object):
         except IOError, e:
             return False
 
-def main():
-    try:
-        srs = subreddits.get_subreddits(pages=config.subreddit_pages)
-    except subreddits.RedesignError, e:
-        print >>sys.stderr, "Reddit has redesigned: %s", (e,)
-        sys.exit(1)
-    except subreddits.SubRedditError, e:
-        print >>sys.stderr, "Serious error: %s!" % e
-        sys.exit(1)
+def sync_subreddits(conn, srs, ranking):
+    """
+    Brings subreddits table in line with scraped subreddits 'srs' (an
+    iterable of dicts, consumed as it is loaded). Does not commit.
 
-    conn = sqlite.connect(database=config.database, timeout=10)
-    conn.row_factory = sqlite.Row
-    cur = conn.cursor()
+    The subreddits are loaded into the 'scraped' temp table, then new ones
+    are inserted, subscriber counts updated, active flags set (if
+    config.subreddit_deactivate is on) and positions rewritten, each with
+    one statement however many subreddits there are. If anything changed,
+    the 'subreddits' generation is bumped, so that the website reloads
+    what it caches of subreddits.
+
+    Returns a tuple of the number of scraped, new, updated, deactivated
+    and moved subreddits.
+    """
 
-    insert_query = ("INSERT INTO subreddits "
+    cur = conn.cursor()
+    cur.execute("DELETE FROM scraped")
+    cur.executemany("INSERT OR IGNORE INTO scraped "
                     "(reddit_name, name, description, subscribers, position) "
                     "VALUES "
-                    "(:reddit_name, :name, :description, :subscribers, :position) ")
-
-    cur.execute("SELECT count(*) FROM subreddits WHERE id > 0");  # id = 0 is reddit's front page
-    sr_count = cur.fetchone()[0]
-    if not sr_count:
-        # no subreddits, fill the database with some
-        cur.executemany(insert_query, srs)
-    else:
-        # update positions and subscriber count
-        for subreddit in srs:
-            cur.execute("SELECT id, position FROM subreddits WHERE reddit_name = :reddit_name", subreddit)
-            existing_sr = cur.fetchone()
-            if not existing_sr:
-                # a new subreddit
-                cur.execute("SELECT id FROM subreddits WHERE position = :position", subreddit)
-                if cur.fetchone():
-                    cur.execute("UPDATE subreddits SET position = ? WHERE position = ?",
-                        (sr_count+1, subreddit['position']))
-                cur.execute(insert_query, subreddit)
-                sr_count += 1
-            else:
-                cur.execute("UPDATE subreddits SET subscribers = ? WHERE id = ?",
-                    (subreddit['subscribers'], existing_sr['id']))
-                if subreddit['position'] != existing_sr['position']:
-                    # exchange the two subreddits
-                    cur.execute("SELECT id FROM subreddits WHERE position = ?", (subreddit['position'],))
-                    exchange_sr = cur.fetchone()
-                    pos_query = "UPDATE subreddits SET position = ? WHERE id = ?"
-                    cur.execute(pos_query, (subreddit['position'], existing_sr['id']))
-                    cur.execute(pos_query, (existing_sr['position'], exchange_sr['id']))
+                    "(:reddit_name, :name, :description, :subscribers, :position) ", srs)
+    scraped = cur.execute("SELECT count(*) FROM scraped").fetchone()[0]
+
+    cur.execute("INSERT INTO subreddits (reddit_name, name, description, subscribers, position) "
+                "SELECT reddit_name, name, description, subscribers, position FROM scraped "
+                "WHERE reddit_name NOT IN (SELECT reddit_name FROM subreddits)")
+    new = cur.rowcount
+
+    cur.execute("UPDATE subreddits "
+                "SET subscribers = (SELECT sc.subscribers FROM scraped sc "
+                "                   WHERE sc.reddit_name = subreddits.reddit_name) "
+                "WHERE id IN (SELECT su.id FROM scraped sc JOIN subreddits su "
+                "             ON su.reddit_name = sc.reddit_name "
+                "             WHERE su.subscribers != sc.subscribers)")
+    updated = cur.rowcount
+
+    activated = deactivated = 0
+    if config.subreddit_deactivate and scraped:
+        cur.execute("UPDATE subreddits SET active = 1 "
+                    "WHERE active = 0 AND reddit_name IN (SELECT reddit_name FROM scraped)")
+        activated = cur.rowcount
+        cur.execute("UPDATE subreddits SET active = 0 "
+                    "WHERE id > 0 AND active = 1 AND reddit_name NOT IN (SELECT reddit_name FROM scraped)")
+        deactivated = cur.rowcount
+
+    # rank the subreddits in the order they were scraped, the ones which
+    # were not found go after them
+    cur.execute("SELECT su.id FROM scraped sc JOIN subreddits su ON su.reddit_name = sc.reddit_name "
+                "ORDER BY sc.position")
+    moved = ranking.rewrite('subreddits', [row[0] for row in cur.fetchall()], 'id > ?', (0,))
+
+    if new or updated or activated or deactivated or moved:
+        riverdb.bump_generation(conn, 'subreddits')
+
+    return scraped, new, updated, deactivated, moved
+
+def main(conn=None):
+    """ Updates subreddits, returns the exit status """
+
+    if conn is None:
+        conn = riverdb.connect()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS scraped ("
+                 "  reddit_name  TEXT     PRIMARY KEY,"
+                 "  name         TEXT,"
+                 "  description  TEXT,"
+                 "  subscribers  INTEGER,"
+                 "  position     INTEGER"
+                 ")")
+    ranking = Ranking(conn)
+
+    # Pages of subreddits link to each other, so they are fetched one after
+    # another, but in a thread of their own, while this thread loads the
+    # previous pages into the database.
+    #
+    srs = fetchpool.prefetch(subreddits.iter_subreddits(pages=config.subreddit_pages))
+    try:
+        scraped, new, updated, deactivated, moved = sync_subreddits(conn, srs, ranking)
+    except subreddits.RedesignError, e:
+        conn.rollback()
+        print >>sys.stderr, "Reddit has redesigned: %s" % e
+        return 1
+    except subreddits.SubRedditError, e:
+        conn.rollback()
+        print >>sys.stderr, "Serious error: %s!" % e
+        return 1
 
     conn.commit()
+    print ("Scraped %d subreddits: %d new, %d updated, %d deactivated, %d moved" %
+           (scraped, new, updated, deactivated, moved))
+    httpclient.client.print_stats()
+    return 0
 
 if __name__ == "__main__":
 
@@ -93,5 +139,13 @@ if __name__ == "__main__":
         print "I might be already running!"
         sys.exit(1)
 
-    main()
+    argv = sys.argv[1:]
+    if "--record" in argv:
+        print "Recording all fetched pages in the response cache"
+        httpclient.set_cache_mode('record')
+    if "--replay" in argv:
+        print "Replaying pages from the response cache, no network"
+        httpclient.set_cache_mode('replay')
+
+    sys.exit(main())
 
@@ -20,6 +20,35 @@ lock_dir = '/home/pkrumins/tests/python/reddit/locks'
 #
 database = '/home/pkrumins/tests/python/reddit/db/redditriver.db'
 
+# database connections (bin/riverdb.py): prepared statements cached per
+# connection, page cache size of the updaters' writer connection and of
+# each read connection (negative numbers are in KiB), and how much of the
+# database file read connections memory map (in bytes)
+#
+db_cached_statements = 200
+db_writer_cache_size = -16000
+db_reader_cache_size = -4000
+db_mmap_size = 64 * 1024 * 1024
+
+# the website reads generations of cached data (bin/riverdb.py) at most
+# every generation_check_interval seconds
+#
+generation_check_interval = 2
+
+# rendered story pages cached by the website (bin/pagecache.py): at most
+# page_cache_size pages, each rendered again after page_cache_ttl seconds
+# even if its stories did not change (to refresh 'posted N hours ago')
+#
+page_cache_size = 1000
+page_cache_ttl = 5 * 60
+
+# compiled templates of the website (web/templating.py) are kept in
+# template_cache_dir (None to compile them at every start). With
+# template_reload on, changed templates are compiled again (development)
+#
+template_cache_dir = '/home/pkrumins/tests/python/reddit/template_cache'
+template_reload = False
+
 # path to mobile website autodiscovery config
 #
 autodisc_config = '/home/pkrumins/tests/python/reddit/config/autodisc.conf'
@@ -28,10 +57,35 @@ autodisc_config = '/home/pkrumins/tests/python/reddit/config/autodisc.conf'
 #
 subreddit_pages = 1
 
+# whether update_subreddits.py deactivates subreddits which are not on the
+# monitored subreddit pages any more (and activates them when they are
+# back). Off, active flags are left as they were set by hand.
+#
+subreddit_deactivate = False
+
 # number of story pages to monitor (used by update_stories.py)
 #
 story_pages = 2
 
+# polling schedule of subreddits (bin/scheduler.py): subreddits whose
+# smoothed churn (new and moved stories per story) reaches
+# schedule_busy_churn are fetched every schedule_min_interval seconds with
+# story_pages pages, quiet ones every schedule_max_interval seconds with
+# one page. An update_stories.py run fetches at most schedule_budget pages.
+#
+schedule_min_interval = 10 * 60
+schedule_max_interval = 3 * 3600
+schedule_busy_churn = 0.5
+schedule_budget = 40
+
+# bin/update_daemon.py runs the updaters every this many seconds and
+# writes what it is doing to daemon_status_file
+#
+daemon_subreddits_interval = 24 * 3600
+daemon_stories_interval = 5 * 60
+daemon_mobile_interval = 2 * 60
+daemon_status_file = '/home/pkrumins/tests/python/reddit/locks/update_daemon.status'
+
 # default subreddit (reddit_name) to display on the front page
 #
 default_subreddit = 'front_page'   # front_page is the 'reddit.com' front page
@@ -40,3 +94,93 @@ default_subreddit = 'front_page'   # front_page is the 'reddit.com' front page
 #
 stories_per_page = 25
 
+# HTML parser backend used to extract stories and subreddits from reddit pages
+# 'soup' builds a BeautifulSoup tree, 'event' is a faster HTMLParser based
+# extractor that does not build a tree (see bin/parsers.py)
+#
+parser_backend = 'soup'
+
+# number of subreddits whose stories are fetched and parsed concurrently
+# (used by update_stories.py)
+#
+fetch_workers = 4
+
+# politeness limits for every host we fetch pages from: at most
+# host_connections concurrent requests, and at least host_delay seconds
+# between starting two requests
+#
+host_connections = 2
+host_delay = 1.0
+
+# http fetch layer (bin/httpclient.py): socket timeout in seconds, and the
+# maximum size of a response in bytes
+#
+http_timeout = 30
+http_max_size = 2 * 1024 * 1024
+
+# socket timeout in seconds when fetching pages for mobile url autodiscovery
+#
+autodisc_timeout = 15
+
+# read pages incrementally when autodiscovering mobile urls and stop as
+# soon as the mobile url is known, or after autodisc_max_bytes bytes
+#
+autodisc_scan = True
+autodisc_max_bytes = 256 * 1024
+
+# response cache of fetched pages (bin/httpcache.py)
+#  'off'    - no caching
+#  'on'     - conditional GETs for reddit pages, unchanged pages are not parsed again
+#  'record' - like 'on', but every fetched page is stored (--record option)
+#  'replay' - pages are served from the cache only, no network (--replay option)
+#
+http_cache_mode = 'on'
+http_cache_dir = '/home/pkrumins/tests/python/reddit/cache'
+
+# cached responses which were not used for http_cache_max_age seconds are
+# deleted (in 'on' mode only, recorded responses are kept)
+#
+http_cache_max_age = 2 * 24 * 3600
+
+# how long autodiscovery results are cached in the database (in seconds),
+# for pages with a mobile version, pages without one, and pages that could
+# not be fetched (used by bin/autodisccache.py). New stories with a page
+# that could not be fetched wait until its error expires.
+#
+autodisc_ttl_found = 30 * 24 * 3600
+autodisc_ttl_none = 7 * 24 * 3600
+autodisc_ttl_error = 6 * 3600
+
+# domains which have not yielded a mobile version for this many pages are
+# not fetched for autodisc_domain_ttl seconds
+#
+autodisc_domain_misses = 5
+autodisc_domain_ttl = 7 * 24 * 3600
+
+# bin/update_mobile.py autodiscovers mobile urls of new stories in
+# autodisc_workers threads, at most autodisc_per_host stories of a host at
+# a time. A story which fails is retried after autodisc_retry_delay seconds
+# (doubled after each attempt), at most autodisc_max_attempts times.
+#
+autodisc_workers = 8
+autodisc_per_host = 2
+autodisc_retry_delay = 15 * 60
+autodisc_max_attempts = 3
+
+# story score and comment history (bin/history.py): samples older than
+# history_full_age seconds are downsampled to one per history_bucket
+# seconds, samples older than history_retention seconds are deleted
+#
+history_full_age = 2 * 24 * 3600
+history_bucket = 3600
+history_retention = 30 * 24 * 3600
+
+# stories which dropped off the monitored pages are moved to the archive
+# table archive_age seconds after they were added (bin/archive.py)
+#
+archive_age = 3 * 24 * 3600
+
+# top stories on stats pages are the stories posted in the last
+# stats_window seconds (kept in top_stories table by bin/summary.py)
+#
+stats_window = 7 * 24 * 3600
@@ -15,27 +15,33 @@ import web
 import sys
 import re
 
-from datetime import datetime, timedelta
-from time import mktime
+from datetime import datetime
+from time import time
 from urlparse import urlparse
 
 sys.path.append(sys.path[0] + '/../config')
+sys.path.append(sys.path[0] + '/../bin')
 
 import riverconfig as config
+import riverdb
+import queries
+import pagecache
+import templating
 
 urls = (
-    '/',                                 'RedditRiver',
-    '/page/(\d+)/?',                     'RedditRiverPage',
-    '/r/([a-zA-Z0-9_.-]+)/?',            'SubRedditRiver',
-    '/r/([a-zA-Z0-9_.-]+)/page/(\d+)/?', 'SubRedditRiverPage',
-    '/reddits/?',                        'SubReddits',
-    '/stats/?',                          'Stats',
-    '/stats/([a-zA-Z0-9_.-]+)/?',        'SubStats',
-    '/about/?',                          'AboutRiver'
+    '/',                                                       'RedditRiver',
+    '/page/(\d+)/?',                                           'RedditRiverPage',
+    '/(after|before)/(\d+)-(\d+)-(\d+)/?',                     'RedditRiverCursor',
+    '/r/([a-zA-Z0-9_.-]+)/?',                                  'SubRedditRiver',
+    '/r/([a-zA-Z0-9_.-]+)/page/(\d+)/?',                       'SubRedditRiverPage',
+    '/r/([a-zA-Z0-9_.-]+)/(after|before)/(\d+)-(\d+)-(\d+)/?', 'SubRedditRiverCursor',
+    '/reddits/?',                                              'SubReddits',
+    '/stats/?',                                                'Stats',
+    '/stats/([a-zA-Z0-9_.-]+)/?',                              'SubStats',
+    '/about/?',                                                'AboutRiver'
 )
 
 web.webapi.internalerror = web.debugerror
-web.config.db_parameters = dict(dbn='sqlite', db=config.database)
 
 # no escaping needs to be done as the data we get from reddit is already escaped
 web.net.htmlquote = lambda x: x
@@ -54,56 +60,119 @@ def get_nice_host(url):
     host = re.sub(r'www?\d*\.', '', host)
     return host
 
+# the website reads tables which bin/migrate.py creates
+riverdb.check_schema()
+
+# rendered story pages, see bin/pagecache.py
+page_cache = pagecache.PageCache()
+
+# all templates are compiled at start, see templating.py
+templates = templating.Templates(sys.path[0] + '/templates',
+    config.template_cache_dir, config.template_reload)
+templates.load_all()
+
+def render(template, terms):
+    """ Outputs a page rendered from a compiled template """
+    web.header('Content-Type', 'text/html; charset=utf-8', unique=True)
+    web.output(templates.render(template, terms))
+
+def known_subreddit(subreddit):
+    """ Returns True if subreddit (reddit_name) is in the database """
+    return subreddit in riverdb.subreddit_ids()
+
+def parse_cursor(position, date_added, id):
+    """ Returns a cursor tuple from URL parts, or None if it is out of range """
+    cursor = (int(position), int(date_added), int(id))
+    if max(cursor) > sys.maxint:
+        return None
+    return cursor
+
 class Stories(object):
-    def __init__(self, subreddit, page):
+    """
+    A page of stories of a subreddit. Pages are either numbered (the
+    legacy /page/N URLs, read with OFFSET) or start after or before a
+    cursor story (read with queries.keyset_seeks, see bin/queries.py).
+    Next and prev links always carry cursors.
+    """
+
+    def __init__(self, subreddit, page=1, direction=None, cursor=None):
         self.subreddit = subreddit
+        self.subreddit_id = riverdb.subreddit_ids()[subreddit]
         self.page = int(page)
         if self.page == 0: self.page = 1
         if self.page > sys.maxint: self.page = 1
+        self.direction = direction
+        self.cursor = cursor
+        if cursor:
+            self.page = None
 
     def _story_query(self):
-        story_query = ("SELECT st.title title, st.url url, st.url_mobile url_mobile, "
-                       "st.score score, st.comments comments, st.user user, "
-                       "st.date_reddit date_reddit "
-                       "FROM stories st "
-                       "LEFT JOIN subreddits su "
-                       "ON st.subreddit_id = su.id "
-                       "WHERE su.reddit_name = '%s' "
-                       "ORDER BY st.position, st.date_added DESC "
-                       "LIMIT %d "
-                       "OFFSET %d")
-
         offset = (self.page - 1) * config.stories_per_page
 
         # We do a trick here of making a query for + 1 story to see if we
         # should display the next page link. If we get +1 story, then
         # the next page exists.
         #
-        query = (story_query % (self.subreddit, config.stories_per_page + 1, offset))
-        return query
+        return queries.river_page, (self.subreddit_id, config.stories_per_page + 1, offset)
 
-    def get(self):
-        query = self._story_query()
-        tmp_stories = web.query(query)
+    def _keyset_stories(self, limit):
+        """ Returns up to 'limit' stories in self.direction from self.cursor,
+        in river order """
 
         stories = []
-        next_page = prev_page = False
-        for idx, s in enumerate(tmp_stories):
-            if idx >= config.stories_per_page:
-                next_page = True
+        for (condition, order), values in zip(queries.keyset_seeks[self.direction],
+                                              (self.cursor, self.cursor[:2], self.cursor[:1])):
+            if len(stories) >= limit:
                 break
-            s.host = get_nice_host(s['url'])
-            s.niceago = web.datestr(datetime.fromtimestamp(s['date_reddit']), datetime.now())
-            stories.append(s)
+            stories += riverdb.query(queries.river_seek % (condition, order),
+                (self.subreddit_id,) + values + (limit - len(stories),))
+        if self.direction == 'before':
+            stories.reverse()
+        return stories
 
-        if self.page != 1:
+    def _get_stories(self):
+        """ Returns a tuple of up to config.stories_per_page stories and
+        whether next and prev pages exist """
+
+        limit = config.stories_per_page + 1
+        if self.direction == 'before':
+            tmp_stories = self._keyset_stories(limit)
+            if len(tmp_stories) == limit:
+                return tmp_stories[1:], True, True
+            # there are not enough stories before the cursor, it is the first page
+            self.direction = self.cursor = None
+            self.page = 1
+
+        if self.direction == 'after':
+            tmp_stories = self._keyset_stories(limit)
             prev_page = True
+        else:
+            query, params = self._story_query()
+            tmp_stories = riverdb.query(query, params)
+            prev_page = self.page != 1
+        return tmp_stories[:config.stories_per_page], len(tmp_stories) == limit, prev_page
+
+    def get(self):
+        """ Returns the terms of the stories template, or None for a cursor
+        page without stories (a made up cursor, or one of a story which
+        was archived since) """
+
+        stories, next_page, prev_page = self._get_stories()
+        if not stories and self.cursor:
+            return None
+        for s in stories:
+            s.host = get_nice_host(s['url'])
+            s.niceago = web.datestr(datetime.fromtimestamp(s['date_reddit']), datetime.now())
 
         next_page_link = prev_page_link = None
         if next_page:
-            next_page_link = self.next_page(self.subreddit, self.page)
+            next_page_link = self.base_url() + "after/" + self.cursor_path(stories[-1])
         if prev_page:
-            prev_page_link = self.prev_page(self.subreddit, self.page)
+            if self.page == 2 or not stories:
+                # a numbered page past the last story links back to the first
+                prev_page_link = self.base_url()
+            else:
+                prev_page_link = self.base_url() + "before/" + self.cursor_path(stories[0])
 
         return {'stories': stories,
                 'next_page': next_page,
@@ -111,84 +180,50 @@ class Stories(object):
                 'next_page_link': next_page_link,
                 'prev_page_link': prev_page_link}
 
+    def cursor_path(self, story):
+        return "%d-%d-%d" % (story['position'], story['date_added'], story['id'])
 
 class RiverStories(Stories):
-    def __init__(self, page=1):
-        super(RiverStories, self).__init__(config.default_subreddit, page)
-
-    def next_page(self, subreddit, page):
-        return "/page/" + str(page + 1)
-
-class RiverStoriesPage(RiverStories):
-    def __init__(self, page):
-        super(RiverStoriesPage, self).__init__(page)
+    def __init__(self, page=1, direction=None, cursor=None):
+        super(RiverStories, self).__init__(config.default_subreddit, page, direction, cursor)
 
-    def prev_page(self, subreddit, page):
-        if page == 2: return "/"
-        return "/page/" + str(page - 1)
+    def base_url(self):
+        return "/"
 
 class SubRiverStories(Stories):
-    def __init__(self, subreddit, page=1):
-        super(SubRiverStories, self).__init__(subreddit, page)
+    def __init__(self, subreddit, page=1, direction=None, cursor=None):
+        super(SubRiverStories, self).__init__(subreddit, page, direction, cursor)
 
-    def next_page(self, subreddit, page):
-        return "/r/" + subreddit + "/page/" + str(page + 1)
-
-class SubRiverStoriesPage(SubRiverStories):
-    def __init__(self, subreddit, page):
-        super(SubRiverStoriesPage, self).__init__(subreddit, page)
-
-    def prev_page(self, subreddit, page):
-        if page == 2:
-            return "/r/" + subreddit 
-        return "/r/" + subreddit + "/page/" + str(page - 1)
+    def base_url(self):
+        return "/r/" + self.subreddit + "/"
 
 class UserStats(object):
     def __init__(self, subreddit=config.default_subreddit, count=10):
         self.subreddit = subreddit
+        self.subreddit_id = riverdb.subreddit_ids()[subreddit]
         self.count = count
 
     def _user_query(self):
-        stats_query = ("SELECT COUNT(st.user) stories, st.user user "
-                       "FROM stories st "
-                       "LEFT JOIN subreddits su "
-                       "ON st.subreddit_id = su.id "
-                       "WHERE su.reddit_name = '%s' "
-                       "GROUP BY user "
-                       "ORDER BY stories DESC "
-                       "LIMIT %d ")
-
-        query = stats_query % (self.subreddit, self.count)
-        return query
+        return queries.top_users, (self.subreddit_id, self.count)
 
     def get(self):
-        query = self._user_query()
-        users = web.query(query)
+        query, params = self._user_query()
+        users = riverdb.query(query, params)
         return users
 
 class StoryStats(object):
     def __init__(self, time_offset, subreddit=config.default_subreddit, count=10):
         self.subreddit = subreddit
+        self.subreddit_id = riverdb.subreddit_ids()[subreddit]
         self.count = count
         self.time_offset = time_offset
 
     def _story_query(self):
-        stats_query = ("SELECT st.title title, st.url url, st.url_mobile url_mobile, "
-                       "st.score score, st.comments comments, st.user user, "
-                       "st.date_reddit date_reddit "
-                       "FROM stories st "
-                       "LEFT JOIN subreddits su "
-                       "ON st.subreddit_id = su.id "
-                       "WHERE su.reddit_name = '%s' AND st.date_reddit >= %d "
-                       "ORDER BY st.score DESC "
-                       "LIMIT %d ")
-
-        query = stats_query % (self.subreddit, self.time_offset, self.count)
-        return query
+        return queries.top_stories, (self.subreddit_id, self.time_offset, self.count)
 
     def get(self):
-        query = self._story_query()
-        tmp_stories = web.query(query)
+        query, params = self._story_query()
+        tmp_stories = riverdb.query(query, params)
         stories = []
         for s in tmp_stories:
             s.host = get_nice_host(s['url'])
@@ -201,59 +236,93 @@ class StoryStats(object):
 # page handlers
 ################
 
+def render_stories(handler, st, subreddit=None):
+    """ Outputs a story page from page_cache, rendering it if the
+    subreddit's stories changed since it was cached, or outputs a 404 for
+    a cursor page without stories """
+
+    def render_page():
+        story_page = st.get()
+        if story_page is None:
+            return None
+        if subreddit:
+            story_page['subreddit'] = subreddit
+        return templates.render('stories.tpl.html', story_page)
+
+    generation = riverdb.get_generation(riverdb.stories_generation(st.subreddit_id))
+    key = (handler, st.subreddit, st.page, st.direction, st.cursor)
+    page = page_cache.get(key, generation, render_page)
+    if page is None:
+        return web.notfound()
+    web.header('Content-Type', 'text/html; charset=utf-8', unique=True)
+    web.output(page)
+
 class RedditRiver(object):
     def GET(self):
         st = RiverStories()
-        story_page = st.get()
-        web.render('stories.tpl.html', story_page)
+        render_stories('river', st)
 
 class RedditRiverPage(object):
     def GET(self, page):
-        st = RiverStoriesPage(page)
-        story_page = st.get()
-        web.render('stories.tpl.html', story_page)
+        st = RiverStories(page)
+        render_stories('river', st)
+
+class RedditRiverCursor(object):
+    def GET(self, direction, position, date_added, id):
+        cursor = parse_cursor(position, date_added, id)
+        if not cursor:
+            return web.notfound()
+        st = RiverStories(direction=direction, cursor=cursor)
+        render_stories('river', st)
 
 class SubRedditRiver(object):
     def GET(self, subreddit):
+        if not known_subreddit(subreddit):
+            return web.notfound()
         st = SubRiverStories(subreddit)
-        story_page = st.get()
-        story_page['subreddit'] = subreddit
-        web.render('stories.tpl.html', story_page)
+        render_stories('subriver', st, subreddit)
 
 class SubRedditRiverPage(object):
     def GET(self, subreddit, page):
-        st = SubRiverStoriesPage(subreddit, page)
-        story_page = st.get()
-        story_page['subreddit'] = subreddit
-        web.render('stories.tpl.html', story_page)
+        if not known_subreddit(subreddit):
+            return web.notfound()
+        st = SubRiverStories(subreddit, page)
+        render_stories('subriver', st, subreddit)
+
+class SubRedditRiverCursor(object):
+    def GET(self, subreddit, direction, position, date_added, id):
+        cursor = parse_cursor(position, date_added, id)
+        if not known_subreddit(subreddit) or not cursor:
+            return web.notfound()
+        st = SubRiverStories(subreddit, direction=direction, cursor=cursor)
+        render_stories('subriver', st, subreddit)
 
 class SubReddits(object):
     def GET(self):
-        subreddits = web.query("SELECT * FROM subreddits WHERE id > 0 and active = 1 ORDER by position")
-        web.render('subreddits.tpl.html')
+        subreddits = riverdb.query(queries.active_subreddits)
+        render('subreddits.tpl.html', {'subreddits': subreddits})
 
 class AboutRiver(object):
     def GET(self):
-        about = True
-        web.render('about.tpl.html')
+        render('about.tpl.html', {'about': True})
 
 class Stats(object):
     def GET(self):
         user_stats = UserStats(count=10).get()
         
-        week_ago = datetime.now() - timedelta(days=7)
-        unix_week = int(mktime(week_ago.timetuple()))
-        story_stats = StoryStats(time_offset = unix_week, count=15).get()
-        web.render('stats.tpl.html', {'user_stats': user_stats, 'story_stats': story_stats})
+        window_start = int(time()) - config.stats_window
+        story_stats = StoryStats(time_offset = window_start, count=15).get()
+        render('stats.tpl.html', {'user_stats': user_stats, 'story_stats': story_stats})
 
 class SubStats(object):
     def GET(self, subreddit):
+        if not known_subreddit(subreddit):
+            return web.notfound()
         user_stats = UserStats(subreddit, count=10).get()
 
-        week_ago = datetime.now() - timedelta(days=7)
-        unix_week = int(mktime(week_ago.timetuple()))
-        story_stats = StoryStats(time_offset = unix_week, subreddit=subreddit, count=15).get()
-        web.render('stats.tpl.html', {'user_stats': user_stats, 'story_stats': story_stats,
+        window_start = int(time()) - config.stats_window
+        story_stats = StoryStats(time_offset = window_start, subreddit=subreddit, count=15).get()
+        render('stats.tpl.html', {'user_stats': user_stats, 'story_stats': story_stats,
             'subreddit': subreddit})
 
 if __name__ == "__main__":
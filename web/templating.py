@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#
+# Peteris Krumins (peter@catonmat.net)
+# http://www.catonmat.net  --  good coders code, great reuse
+#
+# Released under GNU GPL
+#
+# Developed as a part of redditriver.com project
+# Read how it was designed:
+# http://www.catonmat.net/blog/designing-redditriver-dot-com-website
+#
+
+"""
+This module compiles the Cheetah templates of the website once, when the
+website starts, instead of web.render compiling them (on every request
+when web.py's reloader is on).
+
+ * #include's are inlined before a template is compiled, so a story page
+   is a single compiled method which loops over the stories and renders
+   each of them inline.
+ * The Python code Cheetah generates is kept in config.template_cache_dir
+   (if it is set), named after the sha1 of the template source with its
+   includes inlined, so a restarted website does not run Cheetah's
+   compiler again. Running this program fills the cache ahead of time.
+ * With config.template_reload on (for development), a template is
+   compiled again when it, or a template it includes, changes on disk.
+"""
+
+import os
+import re
+import sys
+import hashlib
+import web
+from Cheetah.Compiler import Compiler
+from Cheetah.Filters import Filter
+
+sys.path.append(sys.path[0] + '/../config')
+import riverconfig as config
+
+version = "1.0"
+
+# the same #include syntax as web.render understands, which also allows
+# a line to end with CRLF (as the templates do)
+include_re = re.compile(r'(?!\\)#include \"(.*?)\"\r?($|#)', re.M)
+
+class WebSafe(Filter):
+    """ The output filter web.render uses """
+    def filter(self, val, **keywords):
+        return web.net.websafe(val)
+
+class Templates(object):
+    """ Compiled templates of a directory """
+
+    def __init__(self, directory, cache_dir=None, reload=False):
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.reload = reload
+        self.templates = {}     # name -> (template class, {path: mtime})
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def load_all(self):
+        """ Compiles all templates of the directory """
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.html'):
+                self.templates[name] = self._compile(name)
+
+    def render(self, name, terms):
+        """ Returns template 'name' rendered with terms (a dict) as a string """
+        return str(self.get(name)(searchList=(terms,), filter=WebSafe))
+
+    def get(self, name):
+        """ Returns the compiled template class of template 'name' """
+        entry = self.templates.get(name)
+        if entry is None or (self.reload and self._changed(entry[1])):
+            entry = self._compile(name)
+            self.templates[name] = entry
+        return entry[0]
+
+    def _changed(self, mtimes):
+        for path, mtime in mtimes.items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _inline(self, name, mtimes):
+        """ Returns the source of template 'name' with includes inlined,
+        records modification times of the files read in mtimes """
+
+        path = os.path.join(self.directory, name)
+        mtimes[path] = os.path.getmtime(path)
+        f = open(path)
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        return include_re.sub(lambda match: self._inline(match.group(1), mtimes), source)
+
+    def _compile(self, name):
+        mtimes = {}
+        source = self._inline(name, mtimes)
+
+        code = None
+        code_path = name
+        if self.cache_dir:
+            code_path = os.path.join(self.cache_dir, hashlib.sha1(source).hexdigest() + '.py')
+            if os.path.exists(code_path):
+                f = open(code_path)
+                try:
+                    code = f.read()
+                finally:
+                    f.close()
+
+        if code is None:
+            code = str(Compiler(source=source, mainClassName='GenTemplate'))
+            if self.cache_dir:
+                tmp_path = code_path + '.%d.tmp' % os.getpid()
+                f = open(tmp_path, 'w')
+                try:
+                    f.write(code)
+                finally:
+                    f.close()
+                os.rename(tmp_path, code_path)
+
+        namespace = {}
+        exec compile(code, code_path, 'exec') in namespace
+        return namespace['GenTemplate'], mtimes
+
+if __name__ == "__main__":
+    if not config.template_cache_dir:
+        print >>sys.stderr, "config.template_cache_dir is not set!"
+        sys.exit(1)
+    templates = Templates(sys.path[0] + '/templates', config.template_cache_dir)
+    templates.load_all()
+    print "Compiled %d templates into %s" % (len(templates.templates), config.template_cache_dir)